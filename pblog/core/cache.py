@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cache storages, the full-page response cache and the template fragment
+cache."""
+
+__author__="Wenjun Xiao"
+
+import time, threading
+from collections import OrderedDict
+from utils import Dict, load_module
+
+class MemoryCache(object):
+    """A LRU cache in memory bounded by entries whose entries expire after
+    their TTL. It is the default storage of `PageCache` and `FragmentCache`,
+    another storage should have the same `get`, `set`, `delete` and `clear` methods.
+
+    >>> cache = MemoryCache(max_entries=2)
+    >>> cache.set('a', 1, ttl=60); cache.set('b', 2, ttl=60)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3, ttl=60)
+    >>> cache.get('b') is None, cache.get('a'), cache.get('c')
+    (True, 1, 3)
+    >>> cache.set('d', 4, ttl=-1)
+    >>> cache.get('d') is None
+    True
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value of key, or None if not found or expired."""
+        with self._lock:
+            item = self._entries.pop(key, None)
+            if item is None:
+                return None
+            if item[1] is not None and item[1] <= time.time():
+                return None
+            self._entries[key] = item
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        """Set the value of key which expires after `ttl` seconds, or never
+        expires if `ttl` is None."""
+        expires_at = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+def make_storage(storage=None, **kw):
+    """Make the cache storage by the class or its dotted name, `MemoryCache`
+    by default, or return it if it is an instance already."""
+    if storage is None:
+        storage = MemoryCache
+    elif isinstance(storage, basestring):
+        storage = load_module(storage)
+    if isinstance(storage, type):
+        storage = storage(**kw)
+    return storage
+
+class PageCache(object):
+    """A cache of ready-to-send pages. A page is fresh for `ttl` seconds, and
+    is served stale for at most `stale` seconds more while one request
+    rebuilds it, the others don't wait for the rebuilding. `invalidate`
+    drops all pages at once by starting a new generation of keys, so it
+    works on any storage.
+
+    Args::
+        ttl: the default seconds of a page being fresh.
+        stale: the seconds of a page being served stale after expired.
+        storage: the storage, its class or dotted name, `MemoryCache` by
+                 default.
+        max_entries: the max pages of the default storage.
+
+    >>> cache = PageCache(ttl=60)
+    >>> builds = []
+    >>> def build():
+    ...     builds.append(1)
+    ...     return 'page %d' % len(builds)
+    >>> cache.fetch('/', build), cache.fetch('/', build)
+    ('page 1', 'page 1')
+    >>> cache.invalidate()
+    >>> cache.fetch('/', build, ttl=-1)
+    'page 2'
+    >>> def rebuild():
+    ...     return 'page 3, meanwhile %s' % cache.fetch('/', build)
+    >>> cache.fetch('/', rebuild), cache.fetch('/', build)
+    ('page 3, meanwhile page 2', 'page 3, meanwhile page 2')
+    >>> s = cache.stats()
+    >>> s.hits, s.stale_hits, s.misses
+    (2, 1, 3)
+    """
+
+    def __init__(self, ttl=60, stale=30, storage=None, max_entries=1000):
+        self.ttl = ttl
+        self.stale = stale
+        if storage is None:
+            self.storage = make_storage(max_entries=max_entries)
+        else:
+            self.storage = make_storage(storage)
+        self._generation = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._stale_hits = 0
+        self._misses = 0
+
+    def fetch(self, key, build, ttl=None):
+        """Return the cached page of key, or build it by calling `build()`
+        and cache the result if it isn't None."""
+        key = (self._generation, key)
+        entry = self.storage.get(key)
+        now = time.time()
+        with self._lock:
+            if entry is not None:
+                if now < entry.expires_at:
+                    self._hits += 1
+                    return entry.page
+                if key in self._refreshing:
+                    self._stale_hits += 1
+                    return entry.page
+            self._refreshing.add(key)
+            self._misses += 1
+        try:
+            page = build()
+            if page is not None:
+                if ttl is None:
+                    ttl = self.ttl
+                self.storage.set(key, Dict(page=page, expires_at=time.time() + ttl),
+                    max(ttl, 0) + self.stale)
+            return page
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def invalidate(self):
+        """Drop all the cached pages."""
+        with self._lock:
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return Dict(hits=self._hits, stale_hits=self._stale_hits,
+                misses=self._misses, generation=self._generation)
+
+class FragmentCache(object):
+    """A cache of rendered template fragments. A key is a string, or a tuple
+    whose first item is the invalidation key and the rest tell the variants
+    apart, like ('blogs', 'top', 10). `invalidate(name)` drops all fragments
+    of the invalidation key by bumping its generation, which is kept by the
+    cache itself, so it is never evicted with the fragments.
+
+    Args::
+        ttl: the default seconds of a fragment being cached.
+        storage: the storage, its class or dotted name, `MemoryCache` by
+                 default.
+        max_entries: the max fragments of the default storage.
+
+    >>> cache = FragmentCache()
+    >>> cache.fetch(('blogs', 'top'), lambda: 'top blogs')
+    'top blogs'
+    >>> cache.fetch(('blogs', 'top'), lambda: 'changed')
+    'top blogs'
+    >>> cache.invalidate('comments')
+    >>> cache.fetch(('blogs', 'top'), lambda: 'changed')
+    'top blogs'
+    >>> cache.invalidate('blogs')
+    >>> cache.fetch(('blogs', 'top'), lambda: 'changed')
+    'changed'
+    """
+
+    def __init__(self, ttl=300, storage=None, max_entries=1000):
+        self.ttl = ttl
+        if storage is None:
+            self.storage = make_storage(max_entries=max_entries)
+        else:
+            self.storage = make_storage(storage)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        if isinstance(key, (tuple, list)):
+            name, parts = key[0], tuple(key[1:])
+        else:
+            name, parts = key, ()
+        with self._lock:
+            generation = self._generations.get(name, 0)
+        return ('fragment', name, generation) + parts
+
+    def fetch(self, key, build, ttl=None):
+        """Return the cached fragment of key, or build it by calling
+        `build()` and cache the result."""
+        key = self._key(key)
+        fragment = self.storage.get(key)
+        if fragment is None:
+            fragment = build()
+            self.storage.set(key, fragment, self.ttl if ttl is None else ttl)
+        return fragment
+
+    def invalidate(self, name):
+        """Drop all the fragments of the invalidation key `name`."""
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
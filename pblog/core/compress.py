@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Response compression middleware."""
+
+__author__="Wenjun Xiao"
+
+import zlib
+from http import Request
+from static import is_compressible
+
+# wbits of `zlib.compressobj` for the content codings.
+_CODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+def negotiate_encoding(environ):
+    """Choose 'gzip' or 'deflate' by the quality values in 'Accept-Encoding',
+    'gzip' wins a tie. Return None if neither is acceptable.
+
+    >>> negotiate_encoding({'HTTP_ACCEPT_ENCODING': 'gzip, deflate, br'})
+    'gzip'
+    >>> negotiate_encoding({'HTTP_ACCEPT_ENCODING': 'gzip;q=0.5, deflate'})
+    'deflate'
+    >>> negotiate_encoding({'HTTP_ACCEPT_ENCODING': '*;q=0'})
+    >>> negotiate_encoding({})
+    """
+    codings = Request(environ).accept_encodings
+    best, best_q = None, 0.0
+    for coding in ('gzip', 'deflate'):
+        q = codings.get(coding, codings.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def _header(headers, name):
+    name = name.lower()
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return None
+
+class GzipMiddleware(object):
+    """A WSGI middleware compressing the response body by gzip or deflate
+    negotiated with 'Accept-Encoding'.
+
+    Only '200 OK' responses of compressible content types and at least
+    `min_size` bytes are compressed, responses with 'Content-Encoding' (like
+    precompressed static files) or 'Cache-Control: no-transform' are passed
+    through. 'Vary: Accept-Encoding' is set for every response of any status.
+
+    A list body is compressed at once and sent with 'Content-Length', other
+    iterables are compressed block by block as they are produced, and are
+    passed through as they are if not compressed. The 'ETag' of compressed
+    response is made weak, so 'If-None-Match' still matches the one of the
+    application. So is the 'ETag' of a '304 Not Modified' when a coding is
+    negotiated and it could be compressed by its content type, if any, and
+    headers, so it has the same validators as the '200 OK' it validates.
+
+    Args::
+        app: the WSGI application.
+        min_size: the min body size in bytes to compress.
+        level: the compression level, 1-9.
+        types: the compressible content types, a prefix ends with '/'.
+
+    >>> def app(environ, start_response):
+    ...     start_response('200 OK', [('Content-Type', 'text/html'),
+    ...         ('Content-Length', '2000'), ('ETag', '"abc"')])
+    ...     return ['x' * 2000]
+    >>> def start_response(status, headers, exc_info=None):
+    ...     print status, sorted(headers)
+    >>> body = GzipMiddleware(app)({'HTTP_ACCEPT_ENCODING': 'gzip'}, start_response)
+    200 OK [('Content-Encoding', 'gzip'), ('Content-Length', '35'), ('Content-Type', 'text/html'), ('ETag', 'W/"abc"'), ('Vary', 'Accept-Encoding')]
+    >>> zlib.decompress(body[0], 16 + zlib.MAX_WBITS) == 'x' * 2000
+    True
+    >>> body = GzipMiddleware(app)({}, start_response)
+    200 OK [('Content-Length', '2000'), ('Content-Type', 'text/html'), ('ETag', '"abc"'), ('Vary', 'Accept-Encoding')]
+    >>> def not_modified(environ, start_response):
+    ...     start_response('304 Not Modified', [('ETag', '"abc"')])
+    ...     return []
+    >>> body = GzipMiddleware(not_modified)({'HTTP_ACCEPT_ENCODING': 'gzip'}, start_response)
+    304 Not Modified [('ETag', 'W/"abc"'), ('Vary', 'Accept-Encoding')]
+    """
+
+    def __init__(self, app, min_size=1024, level=6, types=None):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.types = types
+
+    def _compressible(self, content_type):
+        if self.types is None:
+            return is_compressible(content_type)
+        content_type = (content_type or '').split(';', 1)[0].strip().lower()
+        for t in self.types:
+            if content_type == t or (t[-1] == '/' and content_type.startswith(t)):
+                return True
+        return False
+
+    def _transformable(self, headers):
+        if _header(headers, 'Content-Encoding'):
+            return False
+        return 'no-transform' not in (_header(headers, 'Cache-Control') or '').lower()
+
+    def _should_compress(self, status, headers):
+        if status[:3] != '200' or not self._transformable(headers):
+            return False
+        length = _header(headers, 'Content-Length')
+        return length is None or int(length) >= self.min_size
+
+    def __call__(self, environ, start_response):
+        coding = negotiate_encoding(environ)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            coding = None
+        state = dict(started=False, compressor=None)
+
+        def _start_response(status, headers, exc_info=None):
+            state.update(status=status, headers=list(headers), exc_info=exc_info)
+            if exc_info and state['started']:
+                # the error is reraised by the server.
+                start_response(status, headers, exc_info)
+            return _write
+
+        def _begin(length=None):
+            """Call the real start_response with the headers fixed up."""
+            status, headers = state['status'], state['headers']
+            vary = _header(headers, 'Vary')
+            if not vary:
+                headers = headers + [('Vary', 'Accept-Encoding')]
+            elif 'accept-encoding' not in vary.lower():
+                headers = [(k, v) for k, v in headers if k.lower() != 'vary'] + [
+                    ('Vary', '%s, Accept-Encoding' % vary)]
+            compressed = state['compressor'] is not None
+            content_type = _header(headers, 'Content-Type')
+            if compressed or (coding and status[:3] == '304'
+                and (content_type is None or self._compressible(content_type))
+                and self._transformable(headers)):
+                L = []
+                for k, v in headers:
+                    k_lower = k.lower()
+                    if k_lower == 'content-length' and compressed:
+                        continue
+                    if k_lower == 'etag' and not v.startswith('W/'):
+                        v = 'W/' + v
+                    L.append((k, v))
+                if compressed:
+                    L.append(('Content-Encoding', coding))
+                    if length is not None:
+                        L.append(('Content-Length', str(length)))
+                headers = L
+            state['write'] = start_response(status, headers, state['exc_info'])
+            state['started'] = True
+
+        def _write(data):
+            if not state['started']:
+                self._prepare(coding, state)
+                _begin()
+            compressor = state['compressor']
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                state['write'](data)
+
+        result = self.app(environ, _start_response)
+        if state['started']:
+            return self._iter_compressed(result, state['compressor'])
+        if isinstance(result, (list, tuple)):
+            body = ''.join(result)
+            if coding and len(body) >= self.min_size:
+                self._prepare(coding, state)
+            compressor = state['compressor']
+            if compressor is not None:
+                body = compressor.compress(body) + compressor.flush()
+                _begin(len(body))
+            else:
+                _begin()
+            if hasattr(result, 'close'):
+                result.close()
+            return [body]
+        self._prepare(coding, state)
+        _begin()
+        if state['compressor'] is None:
+            # keep the iterable, e.g. 'wsgi.file_wrapper' sent by sendfile.
+            return result
+        return self._iter_compressed(result, state['compressor'])
+
+    def _prepare(self, coding, state):
+        """Create the compressor if the response should be compressed."""
+        if (coding and self._compressible(_header(state['headers'], 'Content-Type'))
+            and self._should_compress(state['status'], state['headers'])):
+            state['compressor'] = zlib.compressobj(self.level, zlib.DEFLATED,
+                _CODINGS[coding])
+
+    def _iter_compressed(self, result, compressor):
+        """Compress the blocks of streaming body, every block is flushed so
+        the client gets the content as early as without compression."""
+        try:
+            if compressor is None:
+                for data in result:
+                    yield data
+            else:
+                for data in result:
+                    if data:
+                        yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                yield compressor.flush()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
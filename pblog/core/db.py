@@ -481,6 +481,11 @@ def with_connection(func):
 def execute(sql, *args):
     return db.execute(sql, *args)
 
+def execute_update(sql, *args):
+    """Execute the insert, update or delete statement and return the count of
+    affected rows, it is committed if not in a transaction."""
+    return db._execute_dml(sql, *args)
+
 def select(tables, what='*', where=None, order=None, group=None, 
         limit=None, offset=None, first=False):
     return db.select(tables, what=what, where=where, order=order,group=group,
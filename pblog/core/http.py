@@ -4,7 +4,7 @@
 
 __author__="Wenjun Xiao"
 
-import threading, urllib, re, logging, cgi, datetime
+import threading, urllib, re, logging, cgi, datetime, email.utils
 from utils import to_str, escape, to_unicode, quote, unquote, Dict
 
 ctx = httpctx = threading.local()
@@ -59,6 +59,7 @@ HTTP_STATUSES = {
     423: 'Locked',
     424: 'Failed Dependency',
     426: 'Upgrade Required',
+    431: 'Request Header Fields Too Large',
 
     # Server Error
     500: 'Internal Server Error',
@@ -73,6 +74,8 @@ HTTP_STATUSES = {
 
 _RE_HTTP_STATUS = re.compile(r'^\d\d\d(\ [\w\ ]+)?$')
 
+_RE_ETAG = re.compile(r'(?:W/)?("[^"]*"|\*)')
+
 _RESPONSE_HEADERS = (
     'Accept-Ranges',
     'Age',
@@ -269,6 +272,63 @@ class InternalServerError(HTTPError):
     def __init__(self, message = None):
         super(InternalServerError, self).__init__(500, message)
 
+class ServiceUnavailable(HTTPError):
+    """503 Service Unavailable
+
+    Raise if the server is temporarily overloaded. The client is told to retry
+    after ``retry_after`` seconds.
+
+    >>> e = ServiceUnavailable(5)
+    >>> e.headers
+    [('Content-Type', 'text/html'), ('Retry-After', '5')]
+    >>> raise e
+    Traceback (most recent call last):
+      ...
+    ServiceUnavailable: 503 Service Unavailable
+    """
+    code = 503
+
+    def __init__(self, retry_after=1, message = None):
+        super(ServiceUnavailable, self).__init__(message=message)
+        self.retry_after = retry_after
+
+    @property
+    def headers(self, environ=None):
+        return [
+            ('Content-Type', 'text/html'),
+            ('Retry-After', str(self.retry_after))
+        ]
+
+serviceunavailable = ServiceUnavailable
+
+class RequestedRangeNotSatisfiable(HTTPError):
+    """416 Requested Range Not Satisfiable
+
+    Raise if none of the ranges in 'Range' header overlaps the resource, the
+    'Content-Range' header tells the current length of the resource.
+
+    >>> raise RequestedRangeNotSatisfiable(1024)
+    Traceback (most recent call last):
+      ...
+    RequestedRangeNotSatisfiable: 416 Requested Range Not Satisfiable
+    >>> RequestedRangeNotSatisfiable(1024).headers
+    [('Content-Type', 'text/html'), ('Content-Range', 'bytes */1024')]
+    """
+    code = 416
+
+    def __init__(self, length, message=None):
+        super(RequestedRangeNotSatisfiable, self).__init__(message=message)
+        self.length = length
+
+    @property
+    def headers(self, environ=None):
+        return [
+            ('Content-Type', 'text/html'),
+            ('Content-Range', 'bytes */%d' % self.length)
+        ]
+
+rangenotsatisfiable = RequestedRangeNotSatisfiable
+
 class Redirect(HTTPError):
     """A '301 Moved Permanently' direct.
     
@@ -322,15 +382,47 @@ class SeeOther(Redirect):
 seeother = SeeOther
 
 class NotModified(Redirect):
-    """A `304 Not Modified` status.
+    """A `304 Not Modified` status, the response has no body. The validators
+    like 'ETag' set on `ctx.response` are kept.
     
     >>> raise NotModified('http://www.example.com/')
     Traceback (most recent call last):
       ...
     NotModified: 304 Not Modified, http://www.example.com/
+    >>> raise NotModified()
+    Traceback (most recent call last):
+      ...
+    NotModified: 304 Not Modified
+    >>> NotModified().headers
+    []
     """
     code = 304
 
+    def __init__(self, location=None):
+        super(NotModified, self).__init__(location)
+
+    @property
+    def headers(self, environ=None):
+        if self.location:
+            return [('Location', self.location)]
+        return []
+
+    def __call__(self, environ, start_response):
+        response = ctx.response
+        response.content = []
+        response.status = self.status
+        response.content_type = None
+        for k, v in self.headers:
+            response.set_header(k, v)
+        return response(environ, start_response)
+
+    def __str__(self):
+        if self.location:
+            return '%s, %s' % (self.status, self.location)
+        return self.status
+
+    __repr__ = __str__
+
 notmodified = NotModified
 
 class TemporaryRedirect(Redirect):
@@ -357,6 +449,17 @@ class Request(object):
     def __init__(self, environ):
         self._environ = environ
 
+    @property
+    def environ(self):
+        '''
+        Get the raw WSGI environ dict.
+
+        >>> r = Request({'REQUEST_METHOD': 'GET'})
+        >>> r.environ['REQUEST_METHOD']
+        'GET'
+        '''
+        return self._environ
+
     @property
     def method(self):
         '''Get request method. The valid returned values are 'GET', 'POST', 'HEAD'.'''
@@ -441,6 +544,105 @@ class Request(object):
         fp = self._environ['wsgi.input']
         return fp.read()
 
+    @property
+    def if_none_match(self):
+        '''
+        Get the entity tags in 'If-None-Match' header as list, the weak
+        indicator 'W/' is removed. Return [] if no such header.
+
+        >>> r = Request({'HTTP_IF_NONE_MATCH': '"abc", W/"1-2", *'})
+        >>> r.if_none_match
+        ['"abc"', '"1-2"', '*']
+        >>> Request({}).if_none_match
+        []
+        '''
+        return _RE_ETAG.findall(self._environ.get('HTTP_IF_NONE_MATCH', ''))
+
+    @property
+    def if_modified_since(self):
+        '''
+        Get the 'If-Modified-Since' header as unix timestamp. Return None if
+        no such header or it's invalid.
+
+        >>> r = Request({'HTTP_IF_MODIFIED_SINCE': 'Sat, 14 Jul 2012 14:06:34 GMT'})
+        >>> r.if_modified_since
+        1342274794
+        >>> Request({'HTTP_IF_MODIFIED_SINCE': 'bad date'}).if_modified_since
+        '''
+        value = self._environ.get('HTTP_IF_MODIFIED_SINCE')
+        if value:
+            t = email.utils.parsedate_tz(value.split(';', 1)[0])
+            if t:
+                return email.utils.mktime_tz(t)
+        return None
+
+    def is_not_modified(self, etag=None, mtime=None):
+        '''
+        Check the conditional headers of GET request with the validators of
+        current resource. 'If-None-Match' takes precedence over
+        'If-Modified-Since'.
+
+        >>> r = Request({'REQUEST_METHOD': 'GET', 'HTTP_IF_NONE_MATCH': 'W/"1-2"'})
+        >>> r.is_not_modified('"1-2"'), r.is_not_modified('"1-3"')
+        (True, False)
+        >>> r = Request({'REQUEST_METHOD': 'GET', 'HTTP_IF_MODIFIED_SINCE': 'Sat, 14 Jul 2012 14:06:34 GMT'})
+        >>> r.is_not_modified(mtime=1342274794.5), r.is_not_modified(mtime=1342274795)
+        (True, False)
+        >>> r.is_not_modified()
+        False
+        '''
+        if self.method not in ('GET', 'HEAD'):
+            return False
+        tags = self.if_none_match
+        if tags:
+            return etag is not None and ('*' in tags or etag in tags)
+        since = self.if_modified_since
+        if since is not None and mtime is not None:
+            return int(mtime) <= since
+        return False
+
+    @property
+    def accept_encodings(self):
+        '''
+        Get the content codings in 'Accept-Encoding' header as dict of coding
+        and its quality value.
+
+        >>> r = Request({'HTTP_ACCEPT_ENCODING': 'gzip;q=0.8, deflate, br;q=0, *;q=0.1'})
+        >>> sorted(r.accept_encodings.items())
+        [('*', 0.1), ('br', 0.0), ('deflate', 1.0), ('gzip', 0.8)]
+        '''
+        if not hasattr(self, '_accept_encodings'):
+            codings = {}
+            for item in self._environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+                coding, _, params = item.partition(';')
+                coding = coding.strip().lower()
+                if not coding:
+                    continue
+                q = 1.0
+                name, _, value = params.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+                codings[coding] = q
+            self._accept_encodings = codings
+        return self._accept_encodings
+
+    def accepts_encoding(self, coding):
+        '''
+        Check if the content coding is acceptable by the client.
+
+        >>> r = Request({'HTTP_ACCEPT_ENCODING': 'gzip, br;q=0'})
+        >>> r.accepts_encoding('gzip'), r.accepts_encoding('br'), r.accepts_encoding('deflate')
+        (True, False, False)
+        >>> Request({'HTTP_ACCEPT_ENCODING': '*'}).accepts_encoding('deflate')
+        True
+        '''
+        codings = self.accept_encodings
+        q = codings.get(coding, codings.get('*', 0.0))
+        return q > 0
+
     @property
     def remote_addr(self):
         '''
@@ -884,9 +1086,43 @@ class Response(object):
             self._content = self._content.encode('utf-8')
 
     def __call__(self, environ, start_response):
-        start_response(self.status, self.headers)
+        '''
+        Start the response and return the body iterable. A str body is sent in
+        one block with 'Content-Length', so the connection can be kept alive,
+        other iterables are streamed by the server, e.g. in chunks. A '204' or
+        '304' response never has a body.
+
+        >>> r = Response(u'hello')
+        >>> r({}, lambda status, headers: None)
+        ['hello']
+        >>> r.content_length
+        '5'
+        >>> r = Response(['a', 'bc'])
+        >>> r({}, lambda status, headers: None)
+        ['a', 'bc']
+        >>> r.content_length
+        '3'
+        >>> r = Response(iter(['a', 'bc']))
+        >>> list(r({}, lambda status, headers: None))
+        ['a', 'bc']
+        >>> r.content_length
+        >>> r = Response('body', '304 Not Modified')
+        >>> r({}, lambda status, headers: None)
+        []
+        >>> r.content_length
+        '''
         self.check_content()
-        return self.content
+        content = self._content
+        if self.status_code in (204, 304):
+            content = []
+            self.unset_header('CONTENT-LENGTH')
+        else:
+            if isinstance(content, str):
+                content = [content]
+            if isinstance(content, (list, tuple)):
+                self.content_length = sum(len(s) for s in content)
+        start_response(self.status, self.headers)
+        return content
 
 if __name__ == '__main__':
     import doctest
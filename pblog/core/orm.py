@@ -81,7 +81,8 @@ class VersionField(Field):
     def __init__(self, name=None):
         super(VersionField, self).__init__(name=name, default=0)
 
-_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
+_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete',
+    'post_insert', 'post_update', 'post_delete'])
 
 class ModelMetaclass(type):
 
@@ -216,18 +217,21 @@ class Model(Dict):
         db.update(self.__table__, where=[(self.__primary_key__.name, getattr(self, pk))],
             **dict([(f.name, getattr(self, f.name)) for f in self.__fields__.itervalues()
                 if f.updatable]))
+        self.post_update and self.post_update()
         return self
 
     def delete(self):
         self.pre_delete and self.pre_delete()
         pk = self.__primary_key__.name
         db.delete(self.__table__, where=[(self.__primary_key__.name, getattr(self, pk))])
+        self.post_delete and self.post_delete()
         return self
 
     def insert(self):
         self.pre_insert and self.pre_insert()
         db.insert(self.__table__,**dict([(f.name, getattr(self, f.name)) 
             for f in self.__fields__.itervalues() if f.insertable]))
+        self.post_insert and self.post_insert()
         return self
 
     @classmethod
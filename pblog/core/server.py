@@ -0,0 +1,1142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Built-in HTTP servers used by `WSGIApplication.run`.
+
+There are three modes::
+
+    simple:
+        The single threaded ``wsgiref`` server, every connection is handled
+        in the accepting thread.
+    threadpool:
+        A fixed pool of worker threads pulls accepted connections from a
+        bounded queue. When the queue is full, the connection is answered
+        with ``503 Service Unavailable`` and ``Retry-After`` immediately, so
+        that an overloaded server sheds load instead of piling up sockets.
+    eventloop:
+        A single thread multiplexes all sockets with epoll (or poll/select),
+        parses HTTP/1.1 requests with keep-alive and pipelining, and only
+        dispatches complete requests to a small bounded `WorkerPool`. The
+        response iterable is consumed in the worker and streamed back by the
+        loop, so thousands of idle keep-alive connections cost a few bytes
+        each instead of a thread.
+
+The `simple` and `threadpool` servers speak HTTP/1.1 with `KeepAliveRequestHandler`:
+a response with 'Content-Length' keeps the connection open until it has been
+idle for ``idle_timeout`` seconds, other responses are sent with chunked
+transfer encoding. The `simple` server has a single thread, an idle connection
+would block all others, so it still closes the connection after every response.
+A kept-alive connection of the `threadpool` server holds its worker while idle,
+so at most ``max_keep_alive`` connections, less than the workers, are kept alive
+at once, and none is kept while accepted connections wait for a worker.
+
+A file returned through ``environ['wsgi.file_wrapper']`` is sent with the
+``sendfile`` system call when `os.sendfile` or the ``pysendfile`` package is
+available, otherwise it is read and written in blocks.
+
+Each worker thread owns its own ``ctx`` (the ``threading.local`` request
+context) and its own database context, so nothing is shared between
+requests that are in flight at the same time.
+"""
+
+__author__="Wenjun Xiao"
+
+import os, sys, time, errno, select, threading, logging, socket, urllib, Queue
+from collections import deque
+from StringIO import StringIO
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+from wsgiref.handlers import format_date_time
+from wsgiref.util import FileWrapper
+from http import HTTPError, BadRequest, ServiceUnavailable, InternalServerError
+from utils import Dict
+
+try:
+    from os import sendfile as _sendfile
+except ImportError:
+    try:
+        # pysendfile, optional on Python 2.
+        from sendfile import sendfile as _sendfile
+    except ImportError:
+        _sendfile = None
+
+SIMPLE = 'simple'
+THREADPOOL = 'threadpool'
+EVENTLOOP = 'eventloop'
+
+class WorkerPool(object):
+    """A fixed pool of worker threads that pull jobs from a bounded queue.
+
+    Args::
+        workers: the number of worker threads.
+        queue_size: the max number of jobs waiting for a worker. Defaults to
+            4 times of ``workers``.
+        initializer: optional function called once in every worker thread
+            before it takes any job.
+
+    For examples::
+        >>> import time
+        >>> pool = WorkerPool(2, queue_size=1)
+        >>> pool.start()
+        >>> done = threading.Event()
+        >>> pool.submit(done.wait)
+        True
+        >>> time.sleep(0.1)
+        >>> pool.submit(done.wait)
+        True
+        >>> time.sleep(0.1)
+        >>> pool.submit(done.wait)
+        True
+        >>> pool.submit(done.wait)
+        False
+        >>> s = pool.stats()
+        >>> s.busy, s.queue_depth, s.utilization, s.rejected
+        (2, 1, 1.0, 1)
+        >>> done.set()
+        >>> pool.stop()
+        >>> pool.stats().busy
+        0
+    """
+    def __init__(self, workers=10, queue_size=None, initializer=None,
+        name='worker'):
+        if workers < 1:
+            raise ValueError('At least one worker is required.')
+        self.workers = workers
+        self.queue_size = workers * 4 if queue_size is None else queue_size
+        self.initializer = initializer
+        self.name = name
+        self._queue = Queue.Queue(self.queue_size)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._busy = 0
+        self._handled = 0
+        self._rejected = 0
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name='%s-%d' % (self.name, i))
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+        logging.info('%d %s thread(s) started, queue size: %d', self.workers,
+            self.name, self.queue_size)
+
+    def submit(self, func, *args):
+        """Put a job into queue, return False if the queue is full."""
+        try:
+            self._queue.put_nowait((func, args))
+            return True
+        except Queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+
+    def _work(self):
+        if self.initializer:
+            try:
+                self.initializer()
+            except Exception:
+                logging.exception('initialize %s failed:',
+                    threading.current_thread().name)
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            func, args = job
+            with self._lock:
+                self._busy += 1
+            try:
+                func(*args)
+            except Exception:
+                logging.exception('%s job failed:', threading.current_thread().name)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    self._handled += 1
+
+    def stop(self, timeout=None):
+        """Stop all workers after the queued jobs have been done."""
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def stats(self):
+        """Return the queue depth and the worker utilization."""
+        with self._lock:
+            busy, handled, rejected = self._busy, self._handled, self._rejected
+        return Dict(
+            workers=self.workers,
+            busy=busy,
+            utilization=float(busy) / self.workers,
+            queue_depth=self._queue.qsize(),
+            queue_size=self.queue_size,
+            handled=handled,
+            rejected=rejected
+        )
+
+def _raw_response(error, version='HTTP/1.0'):
+    """Build the raw bytes of a response for the error which is sent without
+    calling into the application."""
+    body = error.get_body().encode('utf-8')
+    L = ['%s %s' % (version, error.status)]
+    for k, v in error.headers:
+        L.append('%s: %s' % (k, v))
+    L.append('Content-Length: %d' % len(body))
+    L.append('Connection: close')
+    L.append('')
+    L.append(body)
+    return '\r\n'.join(L)
+
+def _file_region(filelike, length=None):
+    """Return (fd, offset, count) of the file to send by `sendfile`, or None
+    if `sendfile` is not available or `filelike` is not a real file."""
+    if _sendfile is None:
+        return None
+    try:
+        fd = filelike.fileno()
+        offset = filelike.tell()
+        size = os.fstat(fd).st_size
+    except (AttributeError, IOError, OSError):
+        return None
+    if length is None:
+        length = size - offset
+    return fd, offset, length
+
+def _sendfile_blocking(sock, in_fd, offset, count):
+    """Send `count` bytes of `in_fd` from `offset` to the socket which may
+    have timeout, return the number of bytes sent."""
+    out_fd = sock.fileno()
+    timeout = sock.gettimeout()
+    sent = 0
+    while sent < count:
+        try:
+            n = _sendfile(out_fd, in_fd, offset + sent, count - sent)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                if not select.select([], [out_fd], [], timeout)[1]:
+                    raise socket.timeout('timed out')
+                continue
+            raise socket.error(e.errno, e.strerror)
+        if not n:
+            break
+        sent += n
+    return sent
+
+class _LimitedInput(object):
+    """The 'wsgi.input' reading at most `length` bytes from `rfile`, so the
+    unread request body can be skipped before the next request.
+
+    >>> f = _LimitedInput(StringIO('a=1\\nb=2GET / HTTP/1.1'), 8)
+    >>> f.readline()
+    'a=1\\n'
+    >>> f.read(1)
+    'b'
+    >>> f.drain()
+    >>> f.read()
+    ''
+    """
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def drain(self):
+        while self.remaining and self.read(65536):
+            pass
+
+class KeepAliveServerHandler(ServerHandler):
+    """A `ServerHandler` speaking HTTP/1.1, which keeps the connection alive
+    when the response length is known, either from 'Content-Length' or by
+    chunked transfer encoding."""
+
+    http_version = '1.1'
+    wsgi_file_wrapper = FileWrapper
+
+    def __init__(self, stdin, stdout, stderr, environ, keep_alive=True):
+        ServerHandler.__init__(self, stdin, stdout, stderr, environ)
+        self.keep_alive = keep_alive
+        self.chunked = False
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers and not self.bodiless():
+            if (self.keep_alive and self.client_is_modern()
+                and self.environ['SERVER_PROTOCOL'] == 'HTTP/1.1'
+                and self.environ['REQUEST_METHOD'] != 'HEAD'):
+                self.headers['Transfer-Encoding'] = 'chunked'
+                self.chunked = True
+            else:
+                self.keep_alive = False
+        del self.headers['Connection']
+        self.headers['Connection'] = self.keep_alive and 'keep-alive' or 'close'
+
+    def write(self, data):
+        if not self.status:
+            raise AssertionError("write() before start_response()")
+        elif not self.headers_sent:
+            self.bytes_sent = len(data)
+            self.send_headers()
+        else:
+            self.bytes_sent += len(data)
+        if self.chunked:
+            if data:
+                self._write('%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self._write(data)
+        self._flush()
+
+    def bodiless(self):
+        """Return True if the status never has a body, like '304'."""
+        return self.status[:3] in ('204', '304')
+
+    def finish_content(self):
+        if not self.headers_sent and self.bodiless():
+            self.send_headers()
+            return
+        ServerHandler.finish_content(self)
+        if self.chunked:
+            self._write('0\r\n\r\n')
+            self._flush()
+
+    def handle_error(self):
+        self.keep_alive = False
+        ServerHandler.handle_error(self)
+
+    def sendfile(self):
+        """Send the file of 'wsgi.file_wrapper' by `sendfile` without copying
+        it through user space."""
+        if self.headers_sent or self.environ['REQUEST_METHOD'] == 'HEAD':
+            return False
+        length = self.headers.get('Content-Length')
+        region = _file_region(self.result.filelike,
+            None if length is None else int(length))
+        if region is None:
+            return False
+        fd, offset, count = region
+        if length is None:
+            self.headers['Content-Length'] = str(count)
+        self.send_headers()
+        self._flush()
+        self.bytes_sent = _sendfile_blocking(self.request_handler.connection,
+            fd, offset, count)
+        if self.bytes_sent < count:
+            # the file was truncated, the client has to see a broken response.
+            self.keep_alive = False
+        return True
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """A request handler serving requests on one connection until the client
+    closes it, or it is idle for the server's ``idle_timeout`` seconds. When
+    ``idle_timeout`` is 0 the connection is closed after the response. A
+    server with `keep_alive` and `release_keep_alive` methods decides if the
+    connection is kept alive after each response."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.idle_timeout = getattr(self.server, 'idle_timeout', 0)
+        self.timeout = self.idle_timeout or None
+        self.kept_alive = False
+        WSGIRequestHandler.setup(self)
+
+    def handle(self):
+        self.close_connection = 1
+        try:
+            self.handle_one_request()
+            while not self.close_connection:
+                self.handle_one_request()
+        finally:
+            if self.kept_alive:
+                self.server.release_keep_alive()
+
+    def may_keep_alive(self):
+        """Return True if the connection may be kept alive after the
+        response being handled."""
+        if not self.idle_timeout or self.close_connection:
+            return False
+        keep_alive = getattr(self.server, 'keep_alive', None)
+        if keep_alive is None:
+            return True
+        if not keep_alive(self.kept_alive):
+            return False
+        self.kept_alive = True
+        return True
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+        environ = self.get_environ()
+        keep_alive = self.may_keep_alive()
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            keep_alive = False
+            stdin = self.rfile
+        else:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            stdin = _LimitedInput(self.rfile, length)
+        environ['wsgi.input'] = stdin
+        handler = KeepAliveServerHandler(stdin, self.wfile, self.get_stderr(),
+            environ, keep_alive)
+        handler.request_handler = self      # backpointer for logging
+        handler.run(self.server.get_app())
+        if handler.keep_alive:
+            stdin.drain()
+        else:
+            self.close_connection = 1
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """A WSGI server dispatching accepted connections to a `WorkerPool`.
+
+    Args::
+        server_address: the (host, port) to listen on.
+        handler_class: the request handler class.
+        workers: the number of worker threads.
+        queue_size: the max number of connections waiting for a worker.
+        retry_after: seconds for 'Retry-After' header when rejected.
+        initializer: optional function called in every worker thread.
+        idle_timeout: seconds to keep an idle connection, a kept-alive
+            connection occupies a worker, so it should be short.
+        max_keep_alive: the max number of connections kept alive at once.
+            Defaults to half of ``workers``, so idle connections never hold
+            all the workers.
+    """
+    # accepted connections may wait in queue, so keep a larger backlog.
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=10,
+        queue_size=None, retry_after=1, initializer=None, idle_timeout=5,
+        max_keep_alive=None):
+        self.pool = WorkerPool(workers, queue_size, initializer)
+        self.retry_after = retry_after
+        self.idle_timeout = idle_timeout
+        self.max_keep_alive = workers // 2 if max_keep_alive is None else \
+            min(max_keep_alive, workers - 1)
+        self._kept_alive = 0
+        self._keep_alive_lock = threading.Lock()
+        WSGIServer.__init__(self, server_address, handler_class)
+        self.pool.start()
+
+    def process_request(self, request, client_address):
+        if not self.pool.submit(self._process_request, request, client_address):
+            self.reject_request(request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def keep_alive(self, kept_alive):
+        """Return True if a connection may be kept alive after its response,
+        `kept_alive` tells if it is kept alive already. A new one takes one of
+        the ``max_keep_alive`` slots, which is given back by
+        `release_keep_alive` when the connection is closed. No connection is
+        kept alive while accepted ones wait for a worker."""
+        if self.pool.stats().queue_depth:
+            return False
+        if kept_alive:
+            return True
+        with self._keep_alive_lock:
+            if self._kept_alive >= self.max_keep_alive:
+                return False
+            self._kept_alive += 1
+            return True
+
+    def release_keep_alive(self):
+        with self._keep_alive_lock:
+            self._kept_alive -= 1
+
+    def reject_request(self, request, client_address):
+        """Reply '503 Service Unavailable' when the queue is full."""
+        logging.warning('queue is full, reject request from %s:%s',
+            *client_address[:2])
+        try:
+            request.sendall(_raw_response(ServiceUnavailable(self.retry_after)))
+        except socket.error:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def stats(self):
+        return self.pool.stats()
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        self.pool.stop()
+
+# Event masks, same values as both epoll and poll use.
+_EV_READ = 0x001
+_EV_WRITE = 0x004
+_EV_ERROR = 0x008 | 0x010
+
+class _PollPoller(object):
+    """Adapter of `select.epoll` and `select.poll` with timeout in seconds."""
+
+    def __init__(self, impl, scale):
+        self._impl = impl
+        self._scale = scale
+        self.register = impl.register
+        self.modify = impl.modify
+        self.unregister = impl.unregister
+
+    def poll(self, timeout):
+        return self._impl.poll(timeout * self._scale)
+
+class _SelectPoller(object):
+    """Poller based on `select.select` for the platforms without poll."""
+
+    def __init__(self):
+        self._fds = {}
+
+    def register(self, fd, events):
+        self._fds[fd] = events
+
+    modify = register
+
+    def unregister(self, fd):
+        self._fds.pop(fd, None)
+
+    def poll(self, timeout):
+        rl = [fd for fd, ev in self._fds.iteritems() if ev & _EV_READ]
+        wl = [fd for fd, ev in self._fds.iteritems() if ev & _EV_WRITE]
+        rl, wl, xl = select.select(rl, wl, self._fds.keys(), timeout)
+        events = {}
+        for L, ev in ((rl, _EV_READ), (wl, _EV_WRITE), (xl, _EV_ERROR)):
+            for fd in L:
+                events[fd] = events.get(fd, 0) | ev
+        return events.items()
+
+def _make_poller():
+    if hasattr(select, 'epoll'):
+        return _PollPoller(select.epoll(), 1)
+    if hasattr(select, 'poll'):
+        return _PollPoller(select.poll(), 1000)
+    return _SelectPoller()
+
+class _FileRegion(object):
+    """Part of a file queued in the output buffer of `_Connection`, which is
+    sent by `sendfile` in the loop thread."""
+
+    def __init__(self, filelike, fd, offset, count):
+        self.filelike = filelike
+        self.fd = fd
+        self.offset = offset
+        self.remaining = count
+
+    def __len__(self):
+        return self.remaining
+
+    def send(self, out_fd):
+        try:
+            n = _sendfile(out_fd, self.fd, self.offset, self.remaining)
+        except OSError as e:
+            raise socket.error(e.errno, e.strerror)
+        if not n:
+            raise socket.error(errno.EIO, 'File truncated while sending')
+        self.offset += n
+        self.remaining -= n
+        return n
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+class _Connection(object):
+    """A client connection of `EventLoopWSGIServer`.
+
+    The input is only touched by the loop thread. The output buffer is filled
+    by the worker running the application and drained by the loop, the worker
+    blocks while too much output is buffered.
+    """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.fd = sock.fileno()
+        self.events = 0
+        self.inbuf = ''
+        self.continued = False
+        self.outbuf = deque()
+        self.out_bytes = 0
+        self.cond = threading.Condition()
+        self.busy = False
+        self.finished = False
+        self.keep_alive = False
+        self.closed = False
+        self.last_active = time.time()
+
+    def push(self, data, high_water):
+        """Queue output, called by worker thread."""
+        with self.cond:
+            while self.out_bytes > high_water and not self.closed:
+                self.cond.wait(1)
+            if self.closed:
+                raise socket.error(errno.EPIPE, 'Connection closed by peer')
+            self.outbuf.append(data)
+            self.out_bytes += len(data)
+
+    def finish(self, keep_alive):
+        """Mark the response is complete, called by worker thread."""
+        with self.cond:
+            self.keep_alive = keep_alive
+            self.finished = True
+
+    def flush(self, low_water):
+        """Send buffered output without blocking, return True if the response
+        has been sent completely."""
+        with self.cond:
+            while self.outbuf:
+                data = self.outbuf[0]
+                region = isinstance(data, _FileRegion)
+                try:
+                    n = data.send(self.fd) if region else self.sock.send(data)
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                self.out_bytes -= n
+                if region:
+                    if data.remaining:
+                        continue
+                    data.close()
+                elif n < len(data):
+                    self.outbuf[0] = data[n:]
+                    break
+                self.outbuf.popleft()
+            if self.out_bytes <= low_water:
+                self.cond.notify_all()
+            return self.finished and not self.outbuf
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for data in self.outbuf:
+                if isinstance(data, _FileRegion):
+                    data.close()
+            self.outbuf.clear()
+            self.out_bytes = 0
+            self.cond.notify_all()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+class EventLoopWSGIServer(object):
+    """A WSGI server multiplexing connections in one thread and running the
+    application on a bounded `WorkerPool`.
+
+    Requests on a connection are handled one by one in order, so pipelined
+    requests are parsed from the buffer after the previous response is done.
+
+    Args::
+        server_address: the (host, port) to listen on.
+        workers: the number of worker threads running the application.
+        queue_size: the max number of requests waiting for a worker, the
+            request is answered with 503 and 'Retry-After' when it's full.
+        retry_after: seconds for 'Retry-After' header when rejected.
+        initializer: optional function called in every worker thread.
+        idle_timeout: seconds to keep an idle connection.
+        max_header_size: the max size of request line and headers.
+        max_body_size: the max size of request body.
+        high_water: the max bytes of buffered output per connection, the
+            worker blocks until the loop sends them.
+    """
+    request_queue_size = 1024
+    server_software = 'promissing/1.0'
+
+    def __init__(self, server_address, workers=10, queue_size=None,
+        retry_after=1, initializer=None, idle_timeout=15,
+        max_header_size=65536, max_body_size=10 * 1024 * 1024,
+        high_water=256 * 1024):
+        self.server_address = server_address
+        self.retry_after = retry_after
+        self.idle_timeout = idle_timeout
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.high_water = high_water
+        self.low_water = high_water // 4
+        self.application = None
+        self.pool = WorkerPool(workers, queue_size, initializer)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(0)
+        self.server_name, self.server_port = self.socket.getsockname()[:2]
+        self._poller = _make_poller()
+        self._poller.register(self.socket.fileno(), _EV_READ)
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            _set_nonblocking(fd)
+        self._poller.register(self._wake_r, _EV_READ)
+        self._conns = {}
+        self._lock = threading.Lock()
+        self._wakeups = set()
+        self._running = False
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self.pool.start()
+
+    def set_app(self, application):
+        self.application = application
+
+    def get_app(self):
+        return self.application
+
+    def stats(self):
+        s = self.pool.stats()
+        s.connections = len(self._conns)
+        return s
+
+    def serve_forever(self, poll_interval=0.5):
+        self._running = True
+        self._stopped.clear()
+        try:
+            while self._running:
+                try:
+                    events = self._poller.poll(poll_interval)
+                except (IOError, OSError, select.error) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, ev in events:
+                    if fd == self._wake_r:
+                        self._drain_wakeup()
+                    elif fd == self.socket.fileno():
+                        self._accept()
+                    else:
+                        conn = self._conns.get(fd)
+                        if conn:
+                            self._handle_event(conn, ev)
+                self._process_wakeups()
+                self._close_idle()
+        finally:
+            self._stopped.set()
+
+    def shutdown(self):
+        self._running = False
+        self._wakeup(None)
+        self._stopped.wait()
+
+    def server_close(self):
+        for conn in self._conns.values():
+            self._close(conn)
+        self.socket.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        self.pool.stop()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(sock, address)
+            self._conns[conn.fd] = conn
+            self._poller.register(conn.fd, _EV_READ)
+            conn.events = _EV_READ
+
+    def _set_events(self, conn, events):
+        if not conn.closed and conn.events != events:
+            self._poller.modify(conn.fd, events)
+            conn.events = events
+
+    def _handle_event(self, conn, ev):
+        try:
+            if ev & _EV_READ:
+                self._handle_read(conn)
+            if ev & _EV_WRITE and not conn.closed:
+                self._handle_write(conn)
+            if ev & _EV_ERROR and not conn.closed and not ev & _EV_READ:
+                self._close(conn)
+        except socket.error:
+            self._close(conn)
+
+    def _handle_read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if not data:
+            self._close(conn)
+            return
+        conn.inbuf += data
+        conn.last_active = time.time()
+        if not conn.busy:
+            self._next_request(conn)
+
+    def _handle_write(self, conn):
+        if conn.flush(self.low_water):
+            self._response_done(conn)
+        elif not conn.outbuf:
+            self._set_events(conn, 0)
+
+    def _next_request(self, conn):
+        """Parse the next buffered request on connection and dispatch it."""
+        try:
+            request = self._parse_request(conn)
+        except HTTPError as e:
+            self._reject(conn, e)
+            return
+        if request is None:
+            self._set_events(conn, _EV_READ)
+            return
+        environ, keep_alive = request
+        conn.busy = True
+        conn.finished = False
+        # Stop reading while the request is in flight, pipelined requests
+        # wait in the buffer and are handled in order.
+        self._set_events(conn, 0)
+        if not self.pool.submit(self._run_app, conn, environ, keep_alive):
+            logging.warning('queue is full, reject request from %s:%s',
+                *conn.address[:2])
+            self._reject(conn, ServiceUnavailable(self.retry_after))
+
+    def _reject(self, conn, error):
+        conn.busy = True
+        conn.outbuf.append(_raw_response(error, 'HTTP/1.1'))
+        conn.out_bytes += len(conn.outbuf[-1])
+        conn.finish(False)
+        self._set_events(conn, _EV_WRITE)
+
+    def _response_done(self, conn):
+        if not conn.keep_alive:
+            self._close(conn)
+            return
+        conn.busy = False
+        conn.finished = False
+        conn.continued = False
+        conn.last_active = time.time()
+        self._next_request(conn)
+
+    def _close(self, conn):
+        if conn.closed:
+            return
+        if self._conns.get(conn.fd) is conn:
+            del self._conns[conn.fd]
+            self._poller.unregister(conn.fd)
+        conn.close()
+
+    def _close_idle(self):
+        if not self.idle_timeout:
+            return
+        deadline = time.time() - self.idle_timeout
+        for conn in self._conns.values():
+            if not conn.busy and conn.last_active < deadline:
+                self._close(conn)
+
+    def _wakeup(self, conn):
+        """Tell the loop that the connection has output, called by worker."""
+        with self._lock:
+            notify = not self._wakeups
+            if conn is not None:
+                self._wakeups.add(conn)
+        if notify or conn is None:
+            try:
+                os.write(self._wake_w, 'x')
+            except OSError as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _process_wakeups(self):
+        with self._lock:
+            conns, self._wakeups = self._wakeups, set()
+        for conn in conns:
+            if conn.closed:
+                continue
+            try:
+                if conn.flush(self.low_water):
+                    self._response_done(conn)
+                elif conn.outbuf:
+                    self._set_events(conn, _EV_WRITE)
+            except socket.error:
+                self._close(conn)
+
+    def _parse_request(self, conn):
+        """Parse a request from the input buffer. Return (environ, keep_alive)
+        or None if the request is incomplete."""
+        buf = conn.inbuf.lstrip('\r\n')
+        end = buf.find('\r\n\r\n')
+        if end < 0:
+            if len(buf) > self.max_header_size:
+                raise HTTPError(431)
+            conn.inbuf = buf
+            return None
+        lines = buf[:end].split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise BadRequest()
+        method, target, version = parts
+        headers = []
+        for line in lines[1:]:
+            if line[:1] in (' ', '\t') and headers:
+                headers[-1] = (headers[-1][0], headers[-1][1] + ' ' + line.strip())
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise BadRequest()
+            headers.append((name.strip(), value.strip()))
+        hdrs = dict((k.upper(), v) for k, v in headers)
+        if 'chunked' in hdrs.get('TRANSFER-ENCODING', '').lower():
+            raise HTTPError(411)
+        try:
+            length = int(hdrs.get('CONTENT-LENGTH') or 0)
+        except ValueError:
+            raise BadRequest()
+        if length > self.max_body_size:
+            raise HTTPError(413)
+        body_start = end + 4
+        if len(buf) - body_start < length:
+            conn.inbuf = buf
+            if hdrs.get('EXPECT', '').lower() == '100-continue' and not conn.continued:
+                conn.continued = True
+                conn.sock.send('HTTP/1.1 100 Continue\r\n\r\n')
+            return None
+        body = buf[body_start:body_start + length]
+        conn.inbuf = buf[body_start + length:]
+        connection = hdrs.get('CONNECTION', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = 'close' not in connection
+        else:
+            keep_alive = 'keep-alive' in connection
+        return self._make_environ(conn, method, target, version, headers,
+            body), keep_alive
+
+    def _make_environ(self, conn, method, target, version, headers, body):
+        if '?' in target:
+            path, query = target.split('?', 1)
+        else:
+            path, query = target, ''
+        if path.startswith('http://') or path.startswith('https://'):
+            path = '/' + path.split('/', 3)[-1]
+        env = {
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+            'SERVER_SOFTWARE': self.server_software,
+            'SERVER_NAME': self.server_name,
+            'SERVER_PORT': str(self.server_port),
+            'SERVER_PROTOCOL': version,
+            'GATEWAY_INTERFACE': 'CGI/1.1',
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'REMOTE_ADDR': conn.address[0],
+            'REMOTE_HOST': '',
+            'CONTENT_LENGTH': str(len(body)) if body else '',
+        }
+        for name, value in headers:
+            key = name.replace('-', '_').upper()
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                if key == 'CONTENT_TYPE':
+                    env[key] = value
+                continue
+            key = 'HTTP_' + key
+            if key in env:
+                env[key] += ',' + value
+            else:
+                env[key] = value
+        return env
+
+    def _response_head(self, status, headers, keep_alive, environ):
+        """Return the response head, whether to keep connection alive, and
+        whether the body is sent in chunks."""
+        names = set(k.lower() for k, v in headers)
+        chunked = False
+        if 'content-length' not in names and status[:3] not in ('204', '304'):
+            if (keep_alive and environ['SERVER_PROTOCOL'] == 'HTTP/1.1'
+                and environ['REQUEST_METHOD'] != 'HEAD'):
+                chunked = True
+            else:
+                keep_alive = False
+        L = ['HTTP/1.1 %s' % status]
+        if 'date' not in names:
+            L.append('Date: %s' % format_date_time(time.time()))
+        if 'server' not in names:
+            L.append('Server: %s' % self.server_software)
+        for k, v in headers:
+            if k.lower() != 'connection':
+                L.append('%s: %s' % (k, v))
+        if chunked:
+            L.append('Transfer-Encoding: chunked')
+        L.append('Connection: %s' % ('keep-alive' if keep_alive else 'close'))
+        L.append('\r\n')
+        return '\r\n'.join(L), keep_alive, chunked
+
+    def _file_region(self, result, state):
+        """Return a `_FileRegion` of the file in 'wsgi.file_wrapper' and set
+        'Content-Length' if missing, or None if `sendfile` can't be used."""
+        headers = state['headers']
+        length = None
+        for k, v in headers:
+            if k.lower() == 'content-length':
+                length = int(v)
+        region = _file_region(result.filelike, length)
+        if region is None:
+            return None
+        if length is None:
+            state['headers'] = list(headers) + [('Content-Length', str(region[2]))]
+        return _FileRegion(result.filelike, *region)
+
+    def _run_app(self, conn, environ, keep_alive):
+        """Run application in worker thread and stream the result back."""
+        state = dict(status=None, headers=None, sent=False, chunked=False,
+            keep_alive=keep_alive)
+        no_body = environ['REQUEST_METHOD'] == 'HEAD'
+
+        def send_head():
+            head, state['keep_alive'], state['chunked'] = self._response_head(
+                state['status'], state['headers'], state['keep_alive'], environ)
+            state['sent'] = True
+            push(head)
+
+        def push(data):
+            conn.push(data, self.high_water)
+            self._wakeup(conn)
+
+        def write(data):
+            if not state['sent']:
+                send_head()
+            if data and not no_body:
+                if state['chunked']:
+                    data = '%x\r\n%s\r\n' % (len(data), data)
+                push(data)
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if state['sent']:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            state['status'], state['headers'] = status, headers
+            return write
+
+        try:
+            result = self.application(environ, start_response)
+            try:
+                region = None
+                if (isinstance(result, FileWrapper) and not no_body
+                    and not state['sent']):
+                    region = self._file_region(result, state)
+                if region is not None:
+                    send_head()
+                    push(region)
+                    # the region closes the file after it has been sent.
+                    result = None
+                else:
+                    for data in result:
+                        write(data)
+                    if not state['sent']:
+                        if (state['status'][:3] not in ('204', '304') and
+                            not any(k.lower() == 'content-length' for k, v in state['headers'])):
+                            state['headers'] = list(state['headers']) + [('Content-Length', '0')]
+                        send_head()
+                    if state['chunked']:
+                        push('0\r\n\r\n')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except socket.error:
+            state['keep_alive'] = False
+        except Exception:
+            logging.exception('Error while serving %s', environ.get('PATH_INFO'))
+            state['keep_alive'] = False
+            if not state['sent']:
+                try:
+                    push(_raw_response(InternalServerError(), 'HTTP/1.1'))
+                except socket.error:
+                    pass
+        conn.finish(state['keep_alive'])
+        self._wakeup(conn)
+
+def _set_nonblocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def make_server(host, port, app, mode=SIMPLE,
+    handler_class=KeepAliveRequestHandler, **options):
+    """Create a server in `mode` listening on `host` and `port` for `app`.
+
+    Args::
+        mode: 'simple', 'threadpool' or 'eventloop'.
+        options: extra arguments for the server class, like workers,
+            queue_size, retry_after, idle_timeout, etc. They are ignored by
+            the 'simple' server.
+    """
+    if mode == SIMPLE:
+        server = WSGIServer((host, port), handler_class)
+        server.idle_timeout = 0
+    elif mode == THREADPOOL:
+        server = ThreadPoolWSGIServer((host, port), handler_class, **options)
+    elif mode == EVENTLOOP:
+        server = EventLoopWSGIServer((host, port), **options)
+    else:
+        raise ValueError('Unknown server mode: %s' % mode)
+    server.set_app(app)
+    return server
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
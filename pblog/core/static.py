@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Static file helpers, the in-memory cache of small static files and the
+build of fingerprinted assets."""
+
+__author__="Wenjun Xiao"
+
+import os, re, time, json, hashlib, mimetypes, zlib, threading, email.utils
+from collections import OrderedDict
+from utils import Dict
+
+# Content types worth compressing, a prefix ends with '/'.
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript',
+    'application/x-javascript', 'application/json', 'application/xml',
+    'image/svg+xml')
+
+def guess_content_type(fpath):
+    """Guess content type by the file extension.
+
+    >>> guess_content_type('/static/css/site.CSS')
+    'text/css'
+    >>> guess_content_type('/static/unknown.xyz')
+    'application/octet-stream'
+    """
+    fext = os.path.splitext(fpath)[1]
+    return mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+
+def file_etag(st):
+    """Make the 'ETag' of file from inode, mtime and size of `os.stat`."""
+    return '"%x-%x-%x"' % (st.st_ino, int(st.st_mtime), st.st_size)
+
+# Extensions of precompressed siblings by content coding, in preference order.
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+def precompressed_sibling(fpath, st, accepts):
+    """Return (coding, path, stat) of the precompressed sibling of the file,
+    like 'site.css.gz' of 'site.css', which is not older than the file and
+    whose coding is accepted by `accepts(coding)`, or None if not found."""
+    for coding, ext in PRECOMPRESSED:
+        if accepts(coding):
+            try:
+                sst = os.stat(fpath + ext)
+            except OSError:
+                continue
+            if sst.st_mtime >= st.st_mtime:
+                return coding, fpath + ext, sst
+    return None
+
+def is_compressible(content_type):
+    """Check if the content type is worth compressing.
+
+    >>> is_compressible('text/html; charset=utf-8'), is_compressible('image/png')
+    (True, False)
+    >>> is_compressible('application/json')
+    True
+    """
+    if not content_type:
+        return False
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    for t in COMPRESSIBLE_TYPES:
+        if content_type == t or (t[-1] == '/' and content_type.startswith(t)):
+            return True
+    return False
+
+def gzip_bytes(data, level=6):
+    """Compress data in gzip format, the output is the same for same data.
+
+    >>> import gzip, StringIO
+    >>> gzip.GzipFile(fileobj=StringIO.StringIO(gzip_bytes('abc' * 100))).read() == 'abc' * 100
+    True
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+# A fingerprinted file name like 'site.0123abcd.css' made by `build_assets`.
+_RE_FINGERPRINTED = re.compile(r'^[^/]+\.[0-9a-f]{8}(\.[^./]+)?$')
+
+# The manifest file of fingerprinted assets under the static directory.
+MANIFEST_NAME = 'manifest.json'
+
+# Max age of the fingerprinted assets, which never change.
+IMMUTABLE_MAX_AGE = 31536000
+
+def fingerprint_name(path, digest):
+    """Insert the first 8 digits of the content digest before the extension.
+
+    >>> fingerprint_name('css/site.css', '0123abcdef')
+    'css/site.0123abcd.css'
+    >>> fingerprint_name('LICENSE', '0123abcdef')
+    'LICENSE.0123abcd'
+    """
+    root, ext = os.path.splitext(path)
+    return '%s.%s%s' % (root, digest[:8], ext)
+
+def is_fingerprinted(path):
+    """Check if the file name is fingerprinted by `fingerprint_name`.
+
+    >>> is_fingerprinted('/static/css/site.0123abcd.css'), is_fingerprinted('site.css')
+    (True, False)
+    """
+    return _RE_FINGERPRINTED.match(os.path.basename(path)) is not None
+
+def _write_atomic(fpath, data):
+    tmp = '%s.tmp%d' % (fpath, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, fpath)
+
+def build_assets(static_dir, gzip_min_size=256, clean=False):
+    """Copy every file under `static_dir` to its fingerprinted name made of
+    the md5 of content, write the '.gz' siblings of compressible files that
+    get smaller, and write the manifest mapping the logical names to the
+    fingerprinted ones, both relative to `static_dir`. Unchanged assets are
+    not rewritten. The stale fingerprinted files are removed if `clean`.
+    Return the manifest dict.
+
+    >>> import tempfile, shutil
+    >>> static_dir = tempfile.mkdtemp()
+    >>> os.mkdir(os.path.join(static_dir, 'css'))
+    >>> with open(os.path.join(static_dir, 'css', 'site.css'), 'w') as f:
+    ...     f.write('body { color: red; }' * 100)
+    >>> manifest = build_assets(static_dir)
+    >>> manifest
+    {'css/site.css': 'css/site.9dd60ef3.css'}
+    >>> sorted(os.listdir(os.path.join(static_dir, 'css')))
+    ['site.9dd60ef3.css', 'site.9dd60ef3.css.gz', 'site.css', 'site.css.gz']
+    >>> build_assets(static_dir) == manifest
+    True
+    >>> shutil.rmtree(static_dir)
+    """
+    manifest, keep = {}, set()
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            fpath = os.path.join(dirpath, fname)
+            rel = os.path.relpath(fpath, static_dir).replace(os.sep, '/')
+            if (rel == MANIFEST_NAME or is_fingerprinted(fname)
+                or fname.endswith(('.gz', '.br')) or '.tmp' in fname):
+                continue
+            with open(fpath, 'rb') as f:
+                data = f.read()
+            target = fingerprint_name(rel, hashlib.md5(data).hexdigest())
+            manifest[rel] = target
+            tpath = os.path.join(static_dir, target)
+            keep.update((tpath, tpath + '.gz'))
+            if not os.path.exists(tpath):
+                _write_atomic(tpath, data)
+            if len(data) < gzip_min_size or not is_compressible(guess_content_type(fname)):
+                continue
+            gzip_data = gzip_bytes(data, 9)
+            if len(gzip_data) >= len(data):
+                continue
+            for path in (tpath, fpath):
+                if not precompressed_sibling(path, os.stat(path), lambda c: c == 'gzip'):
+                    _write_atomic(path + '.gz', gzip_data)
+    if clean:
+        for dirpath, dirnames, filenames in os.walk(static_dir):
+            for fname in filenames:
+                fpath = os.path.join(dirpath, fname)
+                name = fname[:-3] if fname.endswith('.gz') else fname
+                if is_fingerprinted(name) and fpath not in keep:
+                    os.remove(fpath)
+    _write_atomic(os.path.join(static_dir, MANIFEST_NAME),
+        json.dumps(manifest, indent=1, sort_keys=True))
+    return manifest
+
+class AssetManifest(object):
+    """Resolve the logical asset names to the fingerprinted URLs by the
+    manifest written by `build_assets`, the manifest is reloaded if changed.
+    The name not in the manifest, or without manifest, is resolved to its
+    plain URL.
+
+    >>> AssetManifest('/nonexistent').url('css/site.css')
+    '/static/css/site.css'
+    """
+
+    def __init__(self, static_dir, url_prefix='/static/', check_interval=2):
+        self.path = os.path.join(static_dir, MANIFEST_NAME)
+        self.url_prefix = url_prefix
+        self.check_interval = check_interval
+        self._assets = {}
+        self._mtime = None
+        self._checked_at = 0
+
+    def _reload(self):
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            self._assets, self._mtime = {}, None
+            return
+        if mtime != self._mtime:
+            with open(self.path, 'rb') as f:
+                self._assets = json.load(f)
+            self._mtime = mtime
+
+    def url(self, name):
+        self._reload()
+        name = name.lstrip('/')
+        return self.url_prefix + self._assets.get(name, name)
+
+class StaticFileCache(object):
+    """A LRU cache of small static files bounded by total bytes. An entry
+    holds the file content, a gzip variant for compressible types, and the
+    precomputed content type, 'ETag', 'Last-Modified' and length. It is
+    revalidated by `os.stat` at most once every `check_interval` seconds.
+    The precompressed '.gz' and '.br' siblings are loaded if they exist.
+
+    Args::
+        max_bytes: the max total bytes of cached content.
+        max_file_size: the files larger than it are not cached.
+        check_interval: seconds between the mtime checks of an entry.
+        gzip_min_size: the min size of file to keep a gzip variant.
+
+    >>> import tempfile
+    >>> fd, fpath = tempfile.mkstemp(suffix='.css')
+    >>> os.write(fd, 'body { color: red; }' * 100); os.close(fd)
+    2000
+    >>> cache = StaticFileCache(max_bytes=4096, check_interval=0)
+    >>> e = cache.get(fpath)
+    >>> e.content_type, e.length, len(e.data), len(e.gzip_data) < 200
+    ('text/css', 2000, 2000, True)
+    >>> cache.get(fpath) is e
+    True
+    >>> with open(fpath, 'a') as f:
+    ...     f.write('a {}')
+    >>> os.utime(fpath, (0, 0))
+    >>> cache.get(fpath).length
+    2004
+    >>> os.remove(fpath)
+    >>> cache.get(fpath)
+    >>> cache.stats().entries
+    0
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, max_file_size=512 * 1024,
+        check_interval=2, gzip_min_size=1024):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+        self.gzip_min_size = gzip_min_size
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, fpath):
+        """Return the cached entry of the file, or None if the file doesn't
+        exist or is too large to cache."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(fpath)
+            if entry is not None and now - entry.checked_at < self.check_interval:
+                self._entries[fpath] = self._entries.pop(fpath)
+                self._hits += 1
+                return entry
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            self.invalidate(fpath)
+            return None
+        if entry is not None and (entry.mtime, entry.length, entry.ino) == (
+            st.st_mtime, st.st_size, st.st_ino):
+            entry.checked_at = now
+            with self._lock:
+                self._hits += 1
+            return entry
+        self.invalidate(fpath)
+        with self._lock:
+            self._misses += 1
+        if not os.path.isfile(fpath) or st.st_size > self.max_file_size:
+            return None
+        entry = self._load(fpath, st)
+        entry.checked_at = now
+        with self._lock:
+            self._add(fpath, entry)
+        return entry
+
+    def _load(self, fpath, st):
+        with open(fpath, 'rb') as f:
+            data = f.read(st.st_size)
+        content_type = guess_content_type(fpath)
+        variants = {}
+        for coding, ext in PRECOMPRESSED:
+            if precompressed_sibling(fpath, st, lambda c: c == coding):
+                with open(fpath + ext, 'rb') as f:
+                    variants[coding] = f.read()
+        gzip_data = variants.get('gzip')
+        if (gzip_data is None and len(data) >= self.gzip_min_size
+            and is_compressible(content_type)):
+            gzip_data = gzip_bytes(data)
+            if len(gzip_data) >= len(data):
+                gzip_data = None
+        br_data = variants.get('br')
+        return Dict(
+            data=data,
+            gzip_data=gzip_data,
+            br_data=br_data,
+            content_type=content_type,
+            etag=file_etag(st),
+            last_modified=email.utils.formatdate(st.st_mtime, usegmt=True),
+            length=len(data),
+            mtime=st.st_mtime,
+            ino=st.st_ino,
+            nbytes=len(data) + len(gzip_data or '') + len(br_data or ''),
+            checked_at=0
+        )
+
+    def _add(self, fpath, entry):
+        old = self._entries.pop(fpath, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        if entry.nbytes > self.max_bytes:
+            return
+        self._entries[fpath] = entry
+        self._bytes += entry.nbytes
+        while self._bytes > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= old.nbytes
+
+    def invalidate(self, fpath=None):
+        """Remove the file from cache, or all files if `fpath` is None."""
+        with self._lock:
+            if fpath is None:
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                old = self._entries.pop(fpath, None)
+                if old is not None:
+                    self._bytes -= old.nbytes
+
+    def stats(self):
+        with self._lock:
+            return Dict(entries=len(self._entries), bytes=self._bytes,
+                max_bytes=self.max_bytes, hits=self._hits, misses=self._misses)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
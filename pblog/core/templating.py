@@ -4,8 +4,12 @@
 
 __author__="Wenjun Xiao"
 
-import os, time
+import os, time, logging
+from jinja2 import nodes
+from jinja2.ext import Extension
 from conf import settings
+from static import AssetManifest
+from cache import FragmentCache
 
 def datetime_filter(t):
     delta = int(time.time() - t)
@@ -20,19 +24,106 @@ def datetime_filter(t):
     dt = datetime.fromtimestamp(t)
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
+class FragmentCacheExtension(Extension):
+    """The '{% cache key, ttl %}...{% endcache %}' tag caching the rendered
+    block in the `fragment_cache` of environment, for `ttl` seconds or the
+    default of cache if omitted. The key is a string or a tuple whose first
+    item is the invalidation key, like ('blogs', 'top', 10), the block is
+    rendered again after `fragment_cache.invalidate('blogs')`."""
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', args),
+            [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, key, ttl, caller):
+        return self.environment.fragment_cache.fetch(key, caller, ttl)
+
 class Jinja2Engine(object):
+    """The template engine of Jinja2. The compiled templates are kept in
+    `bytecode_cache_dir` if given, so new processes don't compile them
+    again, and the template files are not checked for changes unless in
+    debug mode. `stream` renders a page in chunks of `stream_chunk_size`
+    bytes."""
 
-    def __init__(self, templ_dir, **kw):
-        from jinja2 import Environment, FileSystemLoader
+    def __init__(self, templ_dir, fragment_cache=None, bytecode_cache_dir=None,
+        stream_chunk_size=8192, **kw):
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
         if not 'autoescape' in kw:
             kw['autoescape'] = True
+        if not 'auto_reload' in kw:
+            kw['auto_reload'] = bool(settings.DEBUG)
+        if bytecode_cache_dir:
+            if not os.path.isdir(bytecode_cache_dir):
+                os.makedirs(bytecode_cache_dir)
+            kw['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache_dir)
+        self.stream_chunk_size = stream_chunk_size
+        kw['extensions'] = list(kw.get('extensions', ())) + [FragmentCacheExtension]
         self._env = Environment(loader=FileSystemLoader(templ_dir), **kw)
+        if fragment_cache is not None:
+            self._env.fragment_cache = fragment_cache
+
+    @property
+    def fragment_cache(self):
+        return self._env.fragment_cache
+
+    def precompile(self):
+        """Load all templates to compile them ahead of the first requests,
+        return the count of templates loaded."""
+        from jinja2 import TemplateSyntaxError
+        count = 0
+        for name in self._env.list_templates():
+            try:
+                self._env.get_template(name)
+                count += 1
+            except TemplateSyntaxError:
+                logging.exception('Failed to compile template %s:', name)
+        return count
 
     def add_filter(self, name, fn_filter):
         self._env.filters[name] = fn_filter
 
+    def add_global(self, name, value):
+        self._env.globals[name] = value
+
     def __call__(self, path, model):
         return self._env.get_template(path).render(**model).encode('utf-8')
 
-jinja2_engine = Jinja2Engine(os.path.join(settings.document_root, 'templates'))
+    def stream(self, path, model, chunk_size=None):
+        """Render the template to a generator of UTF-8 chunks of at least
+        `chunk_size` bytes, or `stream_chunk_size` if None, except the last
+        one."""
+        template = self._env.get_template(path)
+        chunk_size = chunk_size or self.stream_chunk_size
+        def _gen():
+            L, size = [], 0
+            for s in template.generate(**model):
+                s = s.encode('utf-8')
+                L.append(s)
+                size += len(s)
+                if size >= chunk_size:
+                    yield ''.join(L)
+                    L, size = [], 0
+            if L:
+                yield ''.join(L)
+        return _gen()
+
+fragment_cache = FragmentCache(**dict(settings.get('FRAGMENT_CACHE') or {}))
+jinja2_engine = Jinja2Engine(os.path.join(settings.document_root, 'templates'),
+    fragment_cache=fragment_cache,
+    bytecode_cache_dir=settings.get('TEMPLATE_BYTECODE_CACHE'),
+    stream_chunk_size=settings.get('TEMPLATE_STREAM_CHUNK_SIZE') or 8192)
 jinja2_engine.add_filter('datetime', datetime_filter)
+jinja2_engine.add_global('asset_url',
+    AssetManifest(os.path.join(settings.document_root, 'static')).url)
@@ -4,7 +4,7 @@
 
 __author__="Wenjun Xiao"
 
-import functools, re, logging
+import functools, re, types, logging, hashlib
 from http import redirect, found, seeother, httpctx
 
 ctx = httpctx
@@ -58,22 +58,28 @@ class ModelAndView(object):
     'Index Page'
     >>> t.model['content']
     'Hello world!'
+    >>> t.etag, t.stream
+    (False, False)
     """
 
-    def __init__(self, view_name, model):
+    def __init__(self, view_name, model, etag=False, stream=False):
         self.view = view_name
         if isinstance(model, dict):
             self.model = model
         else:
             raise ValueError('A dict expected with view.')
+        self.etag = etag
+        self.stream = stream
 
-def view(view_name):
+def view(view_name, stream=False):
     """A decorator that is used to change result to a ModelAndView with given
-     view and the result of  a view function result."""
+     view and the result of  a view function result. The page is rendered
+     and sent in chunks if `stream` and the template engine supports it,
+     which is for large pages."""
     def _decorator(func):
         @functools.wraps(func)
         def _wrapper(*args, **kw):
-            return ModelAndView(view_name, func(*args, **kw))
+            return ModelAndView(view_name, func(*args, **kw), stream=stream)
         return _wrapper
     return _decorator
 
@@ -105,9 +111,107 @@ def interceptor(pattern):
 
 class JsonModel(object):
 
-    def __init__(self, model, encoder=None):
+    def __init__(self, model, encoder=None, etag=False):
         self.model = model
         self.encoder = encoder
+        self.etag = etag
+
+def etag(func):
+    """A decorator that is used to mark the `ModelAndView` or `JsonModel`
+    result of a view function, the application hashes the rendered body as
+    'ETag' and answers a matched 'If-None-Match' with '304 Not Modified'. It
+    must be outside of `view` or `jsonbody`.
+
+    >>> @etag
+    ... @view('index.html')
+    ... def index():
+    ...     return {}
+    >>> index().etag
+    True
+    """
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        rv = func(*args, **kw)
+        if isinstance(rv, (ModelAndView, JsonModel)):
+            rv.etag = True
+        return rv
+    return _wrapper
+
+class CachedPage(object):
+    """A rendered page of `cache_page` with the status, headers and body
+    ready to send, and the 'ETag' of body if the view is marked by `etag`."""
+
+    def __init__(self, status, headers, body, etag=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+
+# Response headers not kept by the cached pages.
+_UNCACHED_HEADERS = frozenset(['set-cookie', 'x-powered-by', 'content-length', 'etag'])
+
+def _render_page(func, args, kw):
+    """Call the view and render the result to a `CachedPage`, or return None
+    with the result if it can't be cached."""
+    rv = func(*args, **kw)
+    app, response = ctx.application, ctx.response
+    body = app.render(rv)
+    if isinstance(body, types.GeneratorType):
+        # a streamed page is joined, the cached one is sent at once.
+        body = ''.join(body)
+    if not isinstance(body, str) or response.status_code != 200 or \
+        getattr(response, '_cookies', None):
+        return None, body
+    headers = [(k, v) for k, v in response.headers
+        if k.lower() not in _UNCACHED_HEADERS]
+    tag = None
+    if getattr(rv, 'etag', False):
+        tag = '"%s"' % hashlib.md5(body).hexdigest()
+    return CachedPage(response.status, headers, body, tag), body
+
+def cache_page(ttl=None, vary=()):
+    """A decorator that is used to cache the rendered page of a view
+    function for anonymous 'GET' requests, by the 'PAGE_CACHE' of
+    application. The page is keyed on path, query string and the values of
+    the request headers in `vary`, and is fresh for `ttl` seconds, the
+    default of 'PAGE_CACHE' if None. It must be outside of `etag`, `view`
+    and `jsonbody`.
+
+    >>> @cache_page(ttl=300, vary=('Accept-Language',))
+    ... @view('index.html')
+    ... def index():
+    ...     return {}
+    >>> index.__name__
+    'index'
+    """
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kw):
+            request = ctx.request
+            cache = getattr(ctx.application, 'page_cache', None)
+            if cache is None or request.method != REQ_GET or \
+                getattr(request, 'user', None) is not None:
+                return func(*args, **kw)
+            key = (request.path_info, request.query_string) + tuple(
+                request.header(h, '') for h in vary)
+            uncached = []
+            def _build():
+                page, body = _render_page(func, args, kw)
+                if page is None:
+                    uncached.append(body)
+                return page
+            page = cache.fetch(key, _build, ttl)
+            return uncached[0] if uncached else page
+        return _wrapper
+    return _decorator
+
+def invalidate_pages():
+    """Drop all the pages cached by `cache_page`, it should be called once
+    the content of pages changed."""
+    app = getattr(ctx, 'application', None)
+    cache = getattr(app, 'page_cache', None)
+    if cache is not None:
+        cache.invalidate()
 
 def jsonbody(*args, **kwargs):
     encoder=None
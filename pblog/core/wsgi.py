@@ -4,12 +4,18 @@
 
 __author__="Wenjun Xiao"
 
-import os,logging, types, importlib, re, mimetypes, functools, json
+import os,logging, types, importlib, re, functools, json, hashlib, itertools
+import email.utils
 from threading import Lock
-from http import ctx, Request, Response, HTTPError, NotFound, Redirect, InternalServerError
+from http import ctx, Request, Response, HTTPError, NotFound, NotModified, Redirect, InternalServerError, \
+    RequestedRangeNotSatisfiable
 from conf import settings
 from webapi import *
 from utils import load_module 
+from static import StaticFileCache, guess_content_type, file_etag, \
+    is_compressible, precompressed_sibling, is_fingerprinted, IMMUTABLE_MAX_AGE
+from compress import GzipMiddleware
+from cache import PageCache
 from autoreload import run_with_reloader
 
 class RouteBase(object):
@@ -203,22 +209,284 @@ class StaticRoute(RouteBase):
     def _gen_regex_pattern(self, pattern):
         return ''.join(['^', re.escape(pattern),'$'])
 
-def _static_file_generator(fpath):
-    BLOCK_SIZE = 8192
+_BLOCK_SIZE = 8192
+
+# More ranges than this in one request are ignored, the full file is sent.
+_MAX_RANGES = 16
+
+def _static_file_generator(fpath, offset=0, length=None):
     with open(fpath, 'rb') as f:
-        block = f.read(BLOCK_SIZE)
-        while block:
+        f.seek(offset)
+        for block in _read_blocks(f, length):
             yield block
-            block = f.read(BLOCK_SIZE)
 
-def _read_static_file(fpath):
+def _read_blocks(f, length=None):
+    while length is None or length > 0:
+        block = f.read(_BLOCK_SIZE if length is None else min(_BLOCK_SIZE, length))
+        if not block:
+            break
+        if length is not None:
+            length -= len(block)
+        yield block
+
+class _FileRange(object):
+    """A file-like object reading `length` bytes from `offset` of the file.
+    It keeps `fileno` and `tell`, so the server can still send it by
+    `sendfile` from 'wsgi.file_wrapper'.
+
+    >>> from StringIO import StringIO
+    >>> f = _FileRange(StringIO('0123456789'), 2, 5)
+    >>> f.read(3), f.read(), f.read()
+    ('234', '56', '')
+    """
+
+    def __init__(self, f, offset, length):
+        f.seek(offset)
+        self._f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._f.read(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def tell(self):
+        return self._f.tell()
+
+    def close(self):
+        self._f.close()
+
+def _parse_ranges(value, size):
+    """Parse the 'Range' header for a resource of `size` bytes, return a list
+    of (first, last) byte positions which are satisfiable, or None if the
+    header is invalid and should be ignored.
+
+    >>> _parse_ranges('bytes=0-499, 500-, -300', 1000)
+    [(0, 499), (500, 999), (700, 999)]
+    >>> _parse_ranges('bytes=900-2000', 1000)
+    [(900, 999)]
+    >>> _parse_ranges('bytes=1000-', 1000)
+    []
+    >>> _parse_ranges('bytes=5-1', 1000)
+    >>> _parse_ranges('items=0-1', 1000)
+    """
+    unit, sep, spec = value.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        try:
+            if first.strip():
+                first = int(first)
+                if last.strip():
+                    last = int(last)
+                    if last < first:
+                        return None
+                else:
+                    last = size - 1
+            else:
+                suffix = int(last)
+                first, last = max(size - suffix, 0), size - 1
+        except ValueError:
+            return None
+        if first < size and last >= first:
+            ranges.append((first, min(last, size - 1)))
+    return ranges
+
+def _requested_ranges(tag, mtime, size):
+    """Return the ranges requested of the static file, or None if the full
+    file should be sent. A 'If-Range' which doesn't match the current 'ETag'
+    or 'Last-Modified' asks for the full file."""
+    request = ctx.request
+    value = request.header('RANGE')
+    if not value or request.method != 'GET':
+        return None
+    if_range = request.header('IF-RANGE')
+    if if_range:
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            if if_range != tag:
+                return None
+        else:
+            t = email.utils.parsedate_tz(if_range)
+            if not t or email.utils.mktime_tz(t) != int(mtime):
+                return None
+    ranges = _parse_ranges(str(value), size)
+    if ranges is None or len(ranges) > _MAX_RANGES:
+        return None
+    if not ranges:
+        raise RequestedRangeNotSatisfiable(size)
+    return ranges
+
+def _file_parts(fpath, ranges):
+    """Yield the blocks generator of every range of file in order."""
+    with open(fpath, 'rb') as f:
+        for first, last in ranges:
+            f.seek(first)
+            yield _read_blocks(f, last - first + 1)
+
+def _multipart_byteranges(tag, ranges, content_type, size, parts):
+    """Return the 'multipart/byteranges' content type, the body length and
+    the body generator of the ranges, `parts` yields the blocks of every
+    range in order."""
+    boundary = hashlib.md5('%s%r' % (tag, ranges)).hexdigest()
+    heads = ['--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+        boundary, content_type, first, last, size) for first, last in ranges]
+    tail = '\r\n--%s--\r\n' % boundary
+    length = sum(len(h) + last - first + 1 for h, (first, last) in zip(heads, ranges))
+    length += 2 * (len(ranges) - 1) + len(tail)
+    def _generator():
+        for i, (head, blocks) in enumerate(itertools.izip(heads, parts)):
+            yield ('\r\n' + head) if i else head
+            for block in blocks:
+                yield block
+        yield tail
+    return 'multipart/byteranges; boundary=%s' % boundary, length, _generator()
+
+def _check_static_validators(tag, last_modified, mtime):
+    response = ctx.response
+    response.set_header('ETag', tag)
+    response.set_header('Last-Modified', last_modified)
+    if ctx.request.is_not_modified(tag, mtime):
+        raise NotModified()
+
+def _set_partial(first, last, size):
+    ctx.response.status = 206
+    ctx.response.set_header('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+
+def _set_immutable():
+    ctx.response.set_header('Cache-Control',
+        'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE)
+
+def _read_cached_file(entry, immutable=False):
+    """Answer the static file from the entry of `StaticFileCache`, the brotli
+    or gzip variant is used if the client accepts it and no range is
+    requested. The response is cached for a year if `immutable`."""
+    response, request = ctx.response, ctx.request
+    data, tag = entry.data, entry.etag
+    if is_compressible(entry.content_type):
+        response.set_header('Vary', 'Accept-Encoding')
+    if not request.header('RANGE'):
+        for coding, variant in (('br', entry.br_data), ('gzip', entry.gzip_data)):
+            if variant is not None and request.accepts_encoding(coding):
+                data, tag = variant, '%s-%s"' % (tag[:-1], coding)
+                response.set_header('Content-Encoding', coding)
+                break
+    _check_static_validators(tag, entry.last_modified, entry.mtime)
+    response.set_header('Accept-Ranges', 'bytes')
+    ranges = _requested_ranges(tag, entry.mtime, entry.length)
+    if immutable:
+        _set_immutable()
+    if ranges and len(ranges) > 1:
+        response.status = 206
+        response.content_type, response.content_length, gen = _multipart_byteranges(
+            tag, ranges, entry.content_type, entry.length,
+            ([data[first:last + 1]] for first, last in ranges))
+        return gen
+    response.content_type = entry.content_type
+    if ranges:
+        first, last = ranges[0]
+        _set_partial(first, last, entry.length)
+        data = data[first:last + 1]
+    return data
+
+def _read_static_file(fpath, cache=None):
+    """Return the static file with 'Content-Length' by 'wsgi.file_wrapper' if
+    the server provides it, so that it can be sent by `sendfile`. The 'ETag'
+    is made of inode, mtime and size, a request with matched validators is
+    answered with '304 Not Modified'. A single range is answered with
+    '206 Partial Content' of the part, multiple ranges are answered with a
+    'multipart/byteranges' body. Small files are served from `cache` if
+    given. The precompressed '.br' or '.gz' sibling of file is preferred if
+    the client accepts it and no range is requested. The fingerprinted
+    assets built by `build_assets` are cached by clients for a year, only
+    the '200 OK' and '206 Partial Content' of them."""
     fpath = os.path.join(ctx.document_root, fpath)
+    immutable = is_fingerprinted(fpath)
+    if cache is not None:
+        entry = cache.get(fpath)
+        if entry is not None:
+            return _read_cached_file(entry, immutable)
     if not os.path.isfile(fpath):
         raise NotFound()
-    fext = os.path.splitext(fpath)[1]
-    ctx.response.content_type = mimetypes.types_map.get(fext.lower(),
-        'application/octet-stream')
-    return _static_file_generator(fpath)
+    st = os.stat(fpath)
+    content_type = guess_content_type(fpath)
+    if is_compressible(content_type):
+        ctx.response.set_header('Vary', 'Accept-Encoding')
+        if not ctx.request.header('RANGE'):
+            sibling = precompressed_sibling(fpath, st, ctx.request.accepts_encoding)
+            if sibling is not None:
+                coding, fpath, st = sibling
+                ctx.response.set_header('Content-Encoding', coding)
+    tag = file_etag(st)
+    _check_static_validators(tag, email.utils.formatdate(st.st_mtime,
+        usegmt=True), st.st_mtime)
+    ctx.response.set_header('Accept-Ranges', 'bytes')
+    ranges = _requested_ranges(tag, st.st_mtime, st.st_size)
+    if immutable:
+        _set_immutable()
+    if ranges and len(ranges) > 1:
+        ctx.response.status = 206
+        ctx.response.content_type, ctx.response.content_length, gen = \
+            _multipart_byteranges(tag, ranges, content_type, st.st_size,
+                _file_parts(fpath, ranges))
+        return gen
+    ctx.response.content_type = content_type
+    offset, length = 0, st.st_size
+    if ranges:
+        first, last = ranges[0]
+        offset, length = first, last - first + 1
+        _set_partial(first, last, st.st_size)
+    ctx.response.content_length = length
+    file_wrapper = ctx.request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        f = open(fpath, 'rb')
+        if ranges:
+            f = _FileRange(f, offset, length)
+        return file_wrapper(f, _BLOCK_SIZE)
+    return _static_file_generator(fpath, offset, length)
+
+_CTX_NAMES = ('application', 'document_root', 'request', 'response')
+
+def _bind_ctx(gen):
+    """Iterate the generator with the context of current request, which is
+    released by `wsgi_app` before the server iterates the response body.
+
+    >>> ctx.request = 'req'
+    >>> def g():
+    ...     yield ctx.request
+    >>> gen = _bind_ctx(g())
+    >>> del ctx.request
+    >>> list(gen), hasattr(ctx, 'request')
+    (['req'], False)
+    >>> ctx.request = 'req'
+    >>> list(_bind_ctx(g())), ctx.request
+    (['req'], 'req')
+    >>> del ctx.request
+    """
+    saved = [(name, getattr(ctx, name)) for name in _CTX_NAMES if hasattr(ctx, name)]
+    def _gen():
+        bound = []
+        for name, value in saved:
+            if not hasattr(ctx, name):
+                setattr(ctx, name, value)
+                bound.append(name)
+        try:
+            for chunk in gen:
+                yield chunk
+        finally:
+            for name in bound:
+                if hasattr(ctx, name):
+                    delattr(ctx, name)
+    return _gen()
 
 class StaticFileRoute(RouteBase):
     """A route return static file if matched. The result is generator of read
@@ -233,6 +501,7 @@ class StaticFileRoute(RouteBase):
         >>> with open(target_file, 'w') as f:
         ...     f.write('test file content.')
         >>> ctx.document_root = doc_root
+        >>> ctx.request = Request({'REQUEST_METHOD': 'GET'})
         >>> ctx.response = Response()
         >>> r = StaticFileRoute('/core/')
         >>> args = r.match('/core/test.tmp')
@@ -241,9 +510,13 @@ class StaticFileRoute(RouteBase):
         >>> os.remove(target_file)
     """
     priority = 7
-    def __init__(self, pattern):
+    def __init__(self, pattern, cache=None):
         super(StaticFileRoute, self).__init__(pattern, REQ_GET, 
-            _read_static_file, ignore_interceptor=True)
+            self._read_file, ignore_interceptor=True)
+        self.cache = cache
+
+    def _read_file(self, fpath):
+        return _read_static_file(fpath, self.cache)
 
     def _gen_regex_pattern(self, pattern):
         re_list = ['^']
@@ -305,6 +578,24 @@ def _build_call_chain(func, target):
         return func(target, *args, **kw)
     return _wrapper
 
+def _chain_initializers(*initializers):
+    """Chain the worker initializers, functions or their dotted names, into
+    one function calling them in order, or return None if there is none.
+
+    >>> init = _chain_initializers(None, 'os.getpid', lambda: 1)
+    >>> init()
+    >>> _chain_initializers(None) is None
+    True
+    """
+    funcs = [load_module(f) if isinstance(f, basestring) else f
+        for f in initializers if f]
+    if not funcs:
+        return None
+    def initializer():
+        for f in funcs:
+            f()
+    return initializer
+
 class WSGIApplication(object):
     """The WSGIApplication object implements a WSGI application and acts as the
     central object. It is passed the document root path.
@@ -416,7 +707,8 @@ class WSGIApplication(object):
         if self._add_route(rfunc):
             self._preprocess_interceptor()
 
-    def run(self, host=None, port=None, autoreload=None, debug=False):
+    def run(self, host=None, port=None, autoreload=None, debug=False,
+        mode=None, **options):
         """Runs the application on a local development server.
 
         Args:
@@ -424,8 +716,14 @@ class WSGIApplication(object):
             port: the port of the webserver. Defaults to ``5100`` or the
                   port defined in the ``SERVER_NAME`` config variable if
                   present.
+            mode: the server mode, ``'simple'``, ``'threadpool'`` or
+                  ``'eventloop'``. Defaults to the ``mode`` in the ``SERVER``
+                  config variable or ``'simple'``.
+            options: the options of server, e.g. ``workers``, ``queue_size``
+                  and ``retry_after`` for ``'threadpool'`` and ``'eventloop'``
+                  mode, override the ones in the ``SERVER`` config variable.
         """
-        from wsgiref.simple_server import make_server
+        from server import make_server, SIMPLE
         if debug: settings.DEBUG = True
         self.autoreload = autoreload
         if host is None:
@@ -436,20 +734,46 @@ class WSGIApplication(object):
                 port = int(server_name.rsplit(':', 1)[1])
             else:
                 port = 5100
-        logging.info('application (%s) will start at %s:%s' % (self.document_root, host, port))
-        server = None
+        conf = dict(settings.get('SERVER') or {})
+        conf.update(options)
+        conf_mode = conf.pop('mode', None)
+        if mode is None:
+            mode = conf_mode or SIMPLE
+        logging.info('application (%s) will start at %s:%s in %s mode' % (
+            self.document_root, host, port, mode))
+        initializer = _chain_initializers(conf.pop('initializer', None),
+            *(settings.get('WORKER_INIT') or ()))
+        if mode != SIMPLE and initializer:
+            conf['initializer'] = initializer
         def runner():
-            server = make_server(host, port, self)
-            server.serve_forever()
+            # load before accepting, so no request waits for the templates.
+            self._ensure_loaded()
+            self.server = make_server(host, port, self, mode, **conf)
+            if mode == SIMPLE and initializer:
+                # requests are handled in this thread.
+                initializer()
+            self.server.serve_forever()
         def stopper():
+            server, self.server = self.server, None
             if server:
                 server.shutdown()
-                server.close()
+                server.server_close()
         if autoreload:
             run_with_reloader(runner, stopper=stopper)
         else:
             runner()
 
+    server = None
+    static_cache = None
+    page_cache = None
+
+    def server_stats(self):
+        """Return the stats of the running server, like queue depth and worker
+        utilization in 'threadpool' mode, or None if not available."""
+        if self.server and hasattr(self.server, 'stats'):
+            return self.server.stats()
+        return None
+
     def dispatch_request(self):
         request = ctx.request
         route, args = self.find_route(request.method, request.path_info)
@@ -481,13 +805,14 @@ class WSGIApplication(object):
             return self.make_model(rv)
         return {}
 
-    def make_response(self, rv):
-        if rv is None:
-            raise NotFound()
-        elif isinstance(rv, HTTPError):
-            return rv
-        elif isinstance(rv, ModelAndView):
-            rv = self._template_engine(rv.view, rv.model)
+    def render(self, rv):
+        """Render the `ModelAndView` or `JsonModel` result of view function
+        to str, other results are returned as they are."""
+        if isinstance(rv, ModelAndView):
+            stream = getattr(self._template_engine, 'stream', None)
+            if rv.stream and stream is not None:
+                return _bind_ctx(stream(rv.view, rv.model))
+            return self._template_engine(rv.view, rv.model)
         elif isinstance(rv, JsonModel):
             try:
                 rv = json.dumps(rv.model, default=rv.encoder)
@@ -496,6 +821,28 @@ class WSGIApplication(object):
                 rv = json.dumps(dict(error='internalerror', data=e.__class__.__name__, 
                     message=e.message))
             ctx.response.content_type = 'application/json'
+        return rv
+
+    def make_response(self, rv):
+        if rv is None:
+            raise NotFound()
+        elif isinstance(rv, HTTPError):
+            return rv
+        tag = None
+        if isinstance(rv, CachedPage):
+            ctx.response.status = rv.status
+            for k, v in rv.headers:
+                ctx.response.set_header(k, v)
+            rv, tag = rv.body, rv.etag
+        else:
+            tagged = getattr(rv, 'etag', False)
+            rv = self.render(rv)
+            if tagged and isinstance(rv, str):
+                tag = '"%s"' % hashlib.md5(rv).hexdigest()
+        if tag:
+            ctx.response.set_header('ETag', tag)
+            if ctx.request.is_not_modified(tag):
+                return NotModified()
         ctx.response.content = rv
         return ctx.response
 
@@ -516,8 +863,12 @@ class WSGIApplication(object):
         if settings.DEBUG:
             logging.warning("Run in debug module, that can't be "
                 "turned on in production...")
-            self.add_route(StaticFileRoute('/static/'))
-            self.add_route(StaticFileRoute('/favicon.ico'))
+            conf = settings.get('STATIC_CACHE')
+            self.static_cache = StaticFileCache(**dict(conf)) if conf else None
+            self.add_route(StaticFileRoute('/static/', self.static_cache))
+            self.add_route(StaticFileRoute('/favicon.ico', self.static_cache))
+        conf = settings.get('PAGE_CACHE')
+        self.page_cache = PageCache(**dict(conf)) if conf else None
         self.scan_modules(settings.MODULE_SCAN)
         def _iter_route(rs):
             for r in rs:
@@ -529,15 +880,24 @@ class WSGIApplication(object):
                 method, '\n'.join(_iter_route(routes)))
         if self.template_engine is None:
             self.template_engine = settings.TEMPLATE_ENGINE
+        precompile = getattr(self.template_engine, 'precompile', None)
+        if precompile is not None:
+            logging.info('Precompiled %d templates', precompile())
 
     initLock = Lock()
 
-    def _lazy_load(self, environ):
+    def _ensure_loaded(self):
+        """Load the settings once, which scans the modules for routes and
+        precompiles the templates. `run` calls it before the server accepts
+        connections, other WSGI servers on the first request."""
         if self.__lazy__ == self._lazy_load:
             with self.initLock:
                 if self.__lazy__ == self._lazy_load:
                     self._load_settings()
                     self.__lazy__ = self._init_ctx
+
+    def _lazy_load(self, environ):
+        self._ensure_loaded()
         self._init_ctx(environ)
 
     __lazy__ = _lazy_load
@@ -558,10 +918,24 @@ class WSGIApplication(object):
             del ctx.response
             del ctx.request
 
+    def _build_app(self, environ, start_response):
+        """Build the application wrapped by the middlewares in settings, like
+        the response compression of 'COMPRESSION', on the first call."""
+        with self.initLock:
+            if self.__app__ == self._build_app:
+                app = self.wsgi_app
+                conf = settings.get('COMPRESSION')
+                if conf:
+                    app = GzipMiddleware(app, **dict(conf))
+                self.__app__ = app
+        return self.__app__(environ, start_response)
+
+    __app__ = _build_app
+
     def __call__(self, environ, start_response):
-        """Shortcut for :attr: `wsgi_app`"""
+        """Shortcut for :attr: `wsgi_app` with the middlewares."""
         try:
-            return self.wsgi_app(environ, start_response)
+            return self.__app__(environ, start_response)
         except:
             logging.exception(" WSGI interface occurs exception:")
             raise
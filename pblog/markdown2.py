@@ -90,13 +90,17 @@ import os
 import sys
 from pprint import pprint
 import re
+import bisect
 import logging
+import threading
+from collections import OrderedDict
 try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
 import optparse
 from random import random, randint
+from time import time as _now
 import codecs
 
 
@@ -151,6 +155,11 @@ g_escape_table = dict([(ch, _hash_text(ch))
 class MarkdownError(Exception):
     pass
 
+class MarkdownLimitError(MarkdownError):
+    """The text is larger than `max_input_size`, nested deeper than
+    `max_nesting`, or converting it takes longer than `time_limit`."""
+    pass
+
 
 
 #---- public api
@@ -169,11 +178,91 @@ def markdown_path(path, encoding="utf-8",
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
-             use_file_vars=False):
+             use_file_vars=False, max_input_size=None, time_limit=None,
+             max_nesting=None):
     return Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars,
+                    max_input_size=max_input_size,
+                    time_limit=time_limit,
+                    max_nesting=max_nesting).convert(text)
+
+def markdown_stream(f, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                    safe_mode=None, extras=None, link_patterns=None):
+    """Yield the HTML of the text read from the seekable file object `f`
+    block by block, see `Markdown.convert_stream`."""
+    return Markdown(html4tags=html4tags, tab_width=tab_width,
+                    safe_mode=safe_mode, extras=extras,
+                    link_patterns=link_patterns).convert_stream(f)
+
+def split_blocks(text, tab_width=DEFAULT_TAB_WIDTH, extras=None):
+    """Return the top-level blocks of the text, split where converting it
+    splits it, see `IncrementalMarkdown.split_blocks`."""
+    return IncrementalMarkdown(tab_width=tab_width,
+                               extras=extras).split_blocks(text)
+
+def convert_many(texts, workers=None, chunksize=None, html4tags=False,
+                 tab_width=DEFAULT_TAB_WIDTH, safe_mode=None, extras=None):
+    """Convert a batch of texts in a pool of `workers` processes and
+    return their HTML in the same order.
+
+    The pool is made on first use and kept for later calls, so the
+    workers and their `Markdown` instances are reused. Texts are sent to
+    the workers in chunks of `chunksize`, a few chunks per worker by
+    default. With one worker, or one text, they are converted in this
+    process.
+    """
+    texts = list(texts)
+    if workers is None:
+        workers = _cpu_count()
+    options = (html4tags, tab_width, safe_mode,
+               tuple(sorted(extras.items())) if isinstance(extras, dict)
+               else tuple(extras or ()))
+    if workers <= 1 or len(texts) <= 1:
+        converter = _make_converter(options)
+        return [converter.convert(text) for text in texts]
+    if chunksize is None:
+        chunksize = max(1, -(-len(texts) // (workers * 4)))
+    return _get_pool(workers).map(_convert_in_worker,
+        [(options, text) for text in texts], chunksize)
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(workers):
+    """Return the process pool of `workers` processes, made once."""
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            import multiprocessing, atexit
+            pool = _pools[workers] = multiprocessing.Pool(workers)
+            atexit.register(pool.terminate)
+        return pool
+
+def _make_converter(options):
+    html4tags, tab_width, safe_mode, extras = options
+    if extras and isinstance(extras[0], tuple):
+        extras = dict(extras)
+    return Markdown(html4tags=html4tags, tab_width=tab_width,
+                    safe_mode=safe_mode, extras=extras or None)
+
+# The `Markdown` instances of a pool worker keyed by options.
+_worker_converters = {}
+
+def _convert_in_worker(job):
+    options, text = job
+    converter = _worker_converters.get(options)
+    if converter is None:
+        converter = _worker_converters[options] = _make_converter(options)
+    return converter.convert(text)
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -197,7 +286,21 @@ class Markdown(object):
     _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
-                 extras=None, link_patterns=None, use_file_vars=False):
+                 extras=None, link_patterns=None, use_file_vars=False,
+                 max_input_size=None, time_limit=None, max_nesting=None,
+                 collect_timings=False):
+        """
+        @param max_input_size {int} The max number of characters of text,
+            `convert` raises `MarkdownLimitError` for a larger one.
+        @param time_limit {float} The seconds `convert` may take. It is
+            checked between the stages, and `MarkdownLimitError` is raised
+            once the time is up.
+        @param max_nesting {int} The max depth of nested block quotes and
+            list items, `convert` raises `MarkdownLimitError` for a deeper
+            one.
+        @param collect_timings {boolean} Record the seconds each stage of
+            the last `convert` took in the `stage_times` dict.
+        """
         if html4tags:
             self.empty_element_suffix = ">"
         else:
@@ -228,6 +331,10 @@ class Markdown(object):
 
         self.link_patterns = link_patterns
         self.use_file_vars = use_file_vars
+        self.max_input_size = max_input_size
+        self.time_limit = time_limit
+        self.max_nesting = max_nesting
+        self.collect_timings = collect_timings
         self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
 
         self._escape_table = g_escape_table.copy()
@@ -249,6 +356,30 @@ class Markdown(object):
             self._count_from_header_id = {} # no `defaultdict` in Python 2.4
         if "metadata" in self.extras:
             self.metadata = {}
+        # The state left by the last `convert`, so an instance can be reused.
+        self._toc = None
+        self._last_li_endswith_two_eols = False
+        self.stage_times = {} if self.collect_timings else None
+        self._deadline = None
+        self._block_depth = 0
+
+    def _check_deadline(self):
+        if self._deadline is not None and _now() > self._deadline:
+            if self.stage_times is not None:
+                # the time of the stage after the last recorded one.
+                self.stage_times["unfinished"] = _now() - self._stage_start
+            raise MarkdownLimitError("conversion took longer than %ss"
+                                     % self.time_limit)
+
+    def _end_stage(self, stage):
+        """Record the time of `stage` just done if timings are collected,
+        and check the deadline."""
+        if self.stage_times is not None:
+            now = _now()
+            self.stage_times[stage] = (self.stage_times.get(stage, 0)
+                                       + now - self._stage_start)
+            self._stage_start = now
+        self._check_deadline()
 
     # Per <https://developer.mozilla.org/en-US/docs/HTML/Element/a> "rel"
     # should only be used in <a> tags with an "href" attribute.
@@ -271,6 +402,13 @@ class Markdown(object):
             #TODO: perhaps shouldn't presume UTF-8 for string input?
             text = unicode(text, 'utf-8')
 
+        if self.max_input_size is not None and len(text) > self.max_input_size:
+            raise MarkdownLimitError("text of %d characters is larger than %d"
+                                     % (len(text), self.max_input_size))
+        self._stage_start = _now()
+        if self.time_limit is not None:
+            self._deadline = self._stage_start + self.time_limit
+
         if self.use_file_vars:
             # Look for emacs-style file variable hints.
             emacs_vars = self._get_emacs_vars(text)
@@ -301,6 +439,7 @@ class Markdown(object):
         # match consecutive blank lines with /\n+/ instead of something
         # contorted like /[ \t]*\n+/ .
         text = self._ws_only_line_re.sub("", text)
+        self._end_stage("prepare")
 
         # strip metadata from head and extract
         if "metadata" in self.extras:
@@ -313,6 +452,7 @@ class Markdown(object):
 
         # Turn block-level HTML blocks into hash entries
         text = self._hash_html_blocks(text, raw=True)
+        self._end_stage("html_blocks")
 
         # Strip link definitions, store in hashes.
         if "footnotes" in self.extras:
@@ -321,8 +461,10 @@ class Markdown(object):
             #   [^4]: this "looks like a link defn"
             text = self._strip_footnote_definitions(text)
         text = self._strip_link_definitions(text)
+        self._end_stage("link_definitions")
 
         text = self._run_block_gamut(text)
+        self._end_stage("block_gamut")
 
         if "footnotes" in self.extras:
             text = self._add_footnotes(text)
@@ -336,6 +478,7 @@ class Markdown(object):
 
         if "nofollow" in self.extras:
             text = self._a_nofollow.sub(r'<\1 rel="nofollow"\2', text)
+        self._end_stage("finish")
 
         text += "\n"
 
@@ -346,6 +489,121 @@ class Markdown(object):
             rv.metadata = self.metadata
         return rv
 
+    # A line starting with one of these can't continue the block before a
+    # blank line, i.e. isn't indented and doesn't start a list item, a
+    # block quote, a table, a fence or HTML.
+    _block_start_chars = r"[^\s>*+\-<`~|\d]"
+    _block_start_re = re.compile(_block_start_chars)
+
+    # The max characters of a block read by `convert_stream`, an unclosed
+    # HTML block or fence is cut at a blank line after it.
+    max_stream_block = 256 * 1024
+
+    def convert_stream(self, f):
+        """Convert the text read from the seekable file object `f`, and
+        yield the HTML of each top-level block, so a large document is
+        converted in bounded memory.
+
+        The file is read twice, first for the link and footnote
+        definitions, then for the blocks, split like in
+        `IncrementalMarkdown`. The joined HTML is the same as `convert`'s
+        except where the whole document matters, as each block is
+        converted alone: a definition between the items of a list ends
+        the list, header ids are numbered in the order of the document,
+        and an HTML tag block is ended in the block it starts in.
+
+        >>> from StringIO import StringIO
+        >>> list(Markdown().convert_stream(StringIO("*a* [b][]\\n\\nc\\n\\n[b]: /b\\n")))
+        [u'<p><em>a</em> <a href="/b">b</a></p>', u'\\n\\n<p>c</p>', '\\n']
+        """
+        self.reset()
+        for text in self._iter_blocks(f):
+            text = self._prepare_block(text)
+            if "footnotes" in self.extras:
+                text = self._strip_footnote_definitions(text)
+            if "[" in text:
+                self._strip_link_definitions(text)
+
+        f.seek(0)
+        sep = ""
+        for i, text in enumerate(self._iter_blocks(f)):
+            text = self._prepare_block(text)
+            if i == 0 and "metadata" in self.extras:
+                text = self._extract_metadata(text)
+            html = self._convert_block(text)
+            if html:
+                yield sep + html
+                sep = "\n\n"
+        if "footnotes" in self.extras and self.footnotes:
+            html = self._finish_block(self._add_footnotes(""))
+            yield sep + html.lstrip("\n")
+        yield "\n"
+
+    _fence_start_re = re.compile(r"```[\w+-]*[ \t]*$")
+
+    def _iter_blocks(self, f):
+        lines, size = [], 0
+        blank = fence = content = False
+        open_tag = None
+        fenced = "fenced-code-blocks" in self.extras
+        for line in f:
+            if not isinstance(line, unicode):
+                line = unicode(line, 'utf-8')
+            if (blank and content and self._block_start_re.match(line)
+                and ((not fence and open_tag is None)
+                     or size > self.max_stream_block)):
+                yield u"".join(lines)
+                lines, size = [], 0
+                fence = content = False
+                open_tag = None
+            if fenced and line.startswith("```"):
+                if fence:
+                    fence = not line.rstrip().strip("`")
+                else:
+                    fence = ((blank or not lines)
+                             and self._fence_start_re.match(line) is not None)
+            if open_tag is None:
+                match = self._tag_block_start_re.match(line)
+                if match and "</%s>" % match.group(1) not in line:
+                    open_tag = match.group(1)
+            elif "</%s>" % open_tag in line:
+                open_tag = None
+            blank = not line.strip()
+            content = content or not blank
+            lines.append(line)
+            size += len(line)
+        if lines:
+            yield u"".join(lines)
+
+    def _prepare_block(self, text):
+        text = re.sub("\r\n|\r", "\n", text) + "\n\n"
+        text = self._detab(text)
+        return self._ws_only_line_re.sub("", text)
+
+    def _convert_block(self, text):
+        # The hashed HTML is only kept for the block.
+        self.html_blocks = {}
+        self.html_spans = {}
+        text = self.preprocess(text)
+        if self.safe_mode:
+            text = self._hash_html_spans(text)
+        text = self._hash_html_blocks(text, raw=True)
+        if "footnotes" in self.extras:
+            text = self._strip_footnote_definitions(text)
+        text = self._strip_link_definitions(text)
+        if not text.strip("\n"):
+            return ""  # only definitions
+        return self._finish_block(self._run_block_gamut(text))
+
+    def _finish_block(self, text):
+        text = self.postprocess(text)
+        text = self._unescape_special_chars(text)
+        if self.safe_mode:
+            text = self._unhash_html_spans(text)
+        if "nofollow" in self.extras:
+            text = self._a_nofollow.sub(r'<\1 rel="nofollow"\2', text)
+        return text
+
     def postprocess(self, text):
         """A hook for subclasses to do some postprocessing of the html, if
         desired. This is called before unescaping of special chars and
@@ -563,6 +821,47 @@ class Markdown(object):
         """ % _block_tags_b,
         re.X | re.M)
 
+    # The start of a tag block, and the end tags the block regexes above
+    # stop at: at the start of a line for the strict one, at the end of a
+    # line for the liberal one.
+    _tag_block_start_re = re.compile(r"^<(%s)\b" % _block_tags_a, re.M)
+    _strict_tag_block_end_re = re.compile(r"^</(%s)>[ \t]*$" % _block_tags_a, re.M)
+    _liberal_tag_block_end_re = re.compile(r"</(%s)>[ \t]*$" % _block_tags_b, re.M)
+
+    def _sub_tag_blocks(self, block_re, end_re, repl, text):
+        """Like `block_re.sub(repl, text)`, but `block_re` is only tried
+        where its end tag occurs later in the text, or right after the
+        start tag.
+
+        A block regex scans to the end of text for every start tag it
+        fails to match, so a text of many unclosed tags takes quadratic
+        time. A start tag with its end tag later in the text always
+        matches, so the others are skipped here.
+        """
+        last_end = {}
+        for match in end_re.finditer(text):
+            last_end[match.group(1)] = match.start()
+        pieces = []
+        done_pos = pos = 0
+        while True:
+            start = self._tag_block_start_re.search(text, pos)
+            if start is None:
+                break
+            pos = start.end()
+            if (last_end.get(start.group(1), -1) < start.start()
+                and not text.startswith('</', pos)):  # like '<p</p>'
+                continue
+            match = block_re.match(text, start.start())
+            if match is None:
+                continue
+            pieces.append(text[done_pos:match.start()])
+            pieces.append(repl(match))
+            done_pos = pos = match.end()
+        if not pieces:
+            return text
+        pieces.append(text[done_pos:])
+        return ''.join(pieces)
+
     _html_markdown_attr_re = re.compile(
         r'''\s+markdown=("1"|'1')''')
     def _hash_html_block_sub(self, match, raw=False):
@@ -617,10 +916,12 @@ class Markdown(object):
         # the inner nested divs must be indented.
         # We need to do this before the next, more liberal match, because the next
         # match will start at the first `<div>` and stop at the first `</div>`.
-        text = self._strict_tag_block_re.sub(hash_html_block_sub, text)
+        text = self._sub_tag_blocks(self._strict_tag_block_re,
+            self._strict_tag_block_end_re, hash_html_block_sub, text)
 
         # Now match more liberally, simply from `\n<tag>` to `</tag>\n`
-        text = self._liberal_tag_block_re.sub(hash_html_block_sub, text)
+        text = self._sub_tag_blocks(self._liberal_tag_block_re,
+            self._liberal_tag_block_end_re, hash_html_block_sub, text)
 
         # Special case just for <hr />. It was easier to make a special
         # case than to make the other regex more complicated.
@@ -699,28 +1000,9 @@ class Markdown(object):
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-
         # Link defs are in the form:
         #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
+        _link_def_re = _link_def_re_from_tab_width(self.tab_width)
         return _link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
@@ -755,22 +1037,7 @@ class Markdown(object):
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
+        footnote_def_re = _footnote_def_re_from_tab_width(self.tab_width)
         return footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
 
@@ -781,6 +1048,20 @@ class Markdown(object):
     ]
 
     def _run_block_gamut(self, text):
+        # Block quotes and list items run the block gamut on their
+        # content recursively, so the nesting is bounded by `max_nesting`.
+        self._check_deadline()
+        self._block_depth += 1
+        try:
+            if (self.max_nesting is not None
+                and self._block_depth > self.max_nesting):
+                raise MarkdownLimitError("blocks are nested deeper than %d"
+                                         % self.max_nesting)
+            return self._run_block_stages(text)
+        finally:
+            self._block_depth -= 1
+
+    def _run_block_stages(self, text):
         # These are all the transformations that form block-level
         # tags like paragraphs, headers, and list items.
 
@@ -886,6 +1167,7 @@ class Markdown(object):
     def _run_span_gamut(self, text):
         # These are all the transformations that occur *within* block-level
         # tags like paragraphs, headers, and list items.
+        self._check_deadline()
 
         text = self._do_code_spans(text)
 
@@ -910,17 +1192,21 @@ class Markdown(object):
             text = self._do_smart_punctuation(text)
 
         # Do hard breaks:
-        text = re.sub(r" {2,}\n", " <br%s\n" % self.empty_element_suffix, text)
+        if "  \n" in text:
+            text = self._hard_break_re.sub(" <br%s\n" % self.empty_element_suffix,
+                                           text)
 
         return text
 
+    _hard_break_re = re.compile(r" {2,}\n")
+
     # "Sorta" because auto-links are identified as "tag" tokens.
     _sorta_html_tokenize_re = re.compile(r"""
         (
             # tag
             </?
             (?:\w+)                                     # tag name
-            (?:\s+(?:[\w-]+:)?[\w-]+=(?:".*?"|'.*?'))*  # attributes
+            (?:\s+(?:[\w-]+:)?[\w-]+=(?:"[^"\n]*"|'[^'\n]*'))*  # attributes
             \s*/?>
             |
             # auto-link (e.g., <http://www.activestate.com/>)
@@ -932,7 +1218,57 @@ class Markdown(object):
         )
         """, re.X)
 
+    def _split_html_tokens(self, text):
+        """Like `self._sorta_html_tokenize_re.split(text)`, but the regex is
+        only tried at a '<' where a token can end later in the text.
+
+        Every token ends with a '>', and a comment or a processing
+        instruction ends on its line. The regex scans to the end of text
+        (or line) for every '<' it fails to match, which takes quadratic
+        time on a text of many unclosed tags, so the '<' without a possible
+        end are skipped here.
+        """
+        last_gt = text.rfind('>')
+        if last_gt == -1:
+            return [text]
+        # The sorted positions of '-->', '?>' and newlines, looked up for
+        # the comments and processing instructions.
+        ends = {}
+        if '<!' in text:
+            ends['!'] = [m.start() for m in re.finditer('-->', text)]
+        if '<?' in text:
+            ends['?'] = [m.start() for m in re.finditer(r'\?>', text)]
+        if ends:
+            newlines = [m.start() for m in re.finditer('\n', text)]
+        tokens = []
+        done_pos = pos = 0
+        while True:
+            pos = text.find('<', pos)
+            if pos == -1 or pos > last_gt:
+                break
+            ch = text[pos+1:pos+2]
+            if ch in ends:
+                i = bisect.bisect_left(ends[ch], pos + (ch == '!' and 4 or 2))
+                j = bisect.bisect_left(newlines, pos)
+                if i == len(ends[ch]) or (j < len(newlines)
+                                          and ends[ch][i] > newlines[j]):
+                    pos += 1
+                    continue
+            match = self._sorta_html_tokenize_re.match(text, pos)
+            if match is None:
+                pos += 1
+                continue
+            tokens.append(text[done_pos:pos])
+            tokens.append(match.group(1))
+            done_pos = pos = match.end()
+        tokens.append(text[done_pos:])
+        return tokens
+
     def _escape_special_chars(self, text):
+        # Optimization: without '<' there is no HTML token.
+        if '<' not in text:
+            return self._encode_backslash_escapes(text)
+
         # Python markdown note: the HTML tokenization here differs from
         # that in Markdown.pl, hence the behaviour for subtle cases can
         # differ (I believe the tokenizer here does a better job because
@@ -941,7 +1277,7 @@ class Markdown(object):
         # here.
         escaped = []
         is_html_markup = False
-        for token in self._sorta_html_tokenize_re.split(text):
+        for token in self._split_html_tokens(text):
             if is_html_markup:
                 # Within tags/HTML-comments/auto-links, encode * and _
                 # so they don't conflict with their use in Markdown for
@@ -968,7 +1304,7 @@ class Markdown(object):
 
         tokens = []
         is_html_markup = False
-        for token in self._sorta_html_tokenize_re.split(text):
+        for token in self._split_html_tokens(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
                 key = _hash_text(sanitized)
@@ -1026,7 +1362,29 @@ class Markdown(object):
           \]
         ''', re.X | re.S)
 
-    def _do_links(self, text):
+    _link_bracket_re = re.compile(r'[\[\]]')
+
+    # The URLs of links and images allowed in safe mode: the ones of these
+    # schemes, or relative ones without a ':' or entity before the path.
+    _safe_url_re = re.compile(r'(?:https?:|ftp:|mailto:|[^:&/?#]*(?:[/?#]|$))', re.I)
+    _url_ignored_chars_re = re.compile(r'[\x00-\x20]+')
+
+    def _safe_url(self, url):
+        """Return the URL of a link or image made safe for safe mode, the
+        one of other schemes, like 'javascript:', is replaced by '#'. The
+        browsers ignore whitespace and control characters in the scheme.
+
+        >>> m = Markdown(safe_mode="escape")
+        >>> m._safe_url("http://a.com/?q=1"), m._safe_url("/a:b"), m._safe_url(" Java\\tScript:x")
+        ('http://a.com/?q=1', '/a:b', '#')
+        >>> m._safe_url("javascript&#58;x"), m._safe_url('a"b')
+        ('#', 'a&quot;b')
+        """
+        if not self._safe_url_re.match(self._url_ignored_chars_re.sub("", url)):
+            return "#"
+        return url.replace('"', '&quot;')
+
+    def _do_links(self, text, anchor_allowed=True):
         """Turn Markdown link shortcuts into XHTML <a> and <img> tags.
 
         This is a combination of Markdown.pl's _DoAnchors() and
@@ -1034,15 +1392,36 @@ class Markdown(object):
         approach. It was necessary to use a different approach than
         Markdown.pl because of the lack of atomic matching support in
         Python's regex engine used in $g_nested_brackets.
+
+        The result is built up in pieces instead of splicing each link
+        into the whole text, and the text of an anchor is scanned for
+        img links by a nested call with `anchor_allowed` false, so the
+        time is linear in the length of text rather than in the length
+        times the number of links. The matching brackets are paired in
+        one pass up front too.
         """
-        MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
+        # Optimization.
+        if '[' not in text:
+            return text
 
-        # `anchor_allowed_pos` is used to support img links inside
-        # anchors, but not anchors inside anchors. An anchor's start
-        # pos must be `>= anchor_allowed_pos`.
-        anchor_allowed_pos = 0
+        MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
 
+        # The matching ']' of every '[', found in one pass.
+        closing_pos = {}
+        opening_pos = []
+        for match in self._link_bracket_re.finditer(text):
+            if match.group() == '[':
+                opening_pos.append(match.start())
+            elif opening_pos:
+                closing_pos[opening_pos.pop()] = match.start()
+        # The tails of links can't match after the last ')' or ']'.
+        last_paren = text.rfind(')')
+        last_bracket = text.rfind(']')
+
+        pieces = []
+        done_pos = 0  # `text[:done_pos]` is in `pieces` already.
         curr_pos = 0
+        text_length = len(text)
         while True: # Handle the next link.
             # The next '[' is the start of:
             # - an inline anchor:   [text](url "title")
@@ -1059,28 +1438,17 @@ class Markdown(object):
             #   These have already been stripped in
             #   _strip_link_definitions() so no need to watch for them.
             # - not markup:         [...anything else...
-            try:
-                start_idx = text.index('[', curr_pos)
-            except ValueError:
+            start_idx = text.find('[', curr_pos)
+            if start_idx == -1:
                 break
-            text_length = len(text)
 
             # Find the matching closing ']'.
             # Markdown.pl allows *matching* brackets in link text so we
             # will here too. Markdown.pl *doesn't* currently allow
             # matching brackets in img alt text -- we'll differ in that
             # regard.
-            bracket_depth = 0
-            for p in range(start_idx+1, min(start_idx+MAX_LINK_TEXT_SENTINEL,
-                                            text_length)):
-                ch = text[p]
-                if ch == ']':
-                    bracket_depth -= 1
-                    if bracket_depth < 0:
-                        break
-                elif ch == '[':
-                    bracket_depth += 1
-            else:
+            p = closing_pos.get(start_idx)
+            if p is None or p >= start_idx + MAX_LINK_TEXT_SENTINEL:
                 # Closing bracket not found within sentinel length.
                 # This isn't markup.
                 curr_pos = start_idx + 1
@@ -1095,20 +1463,21 @@ class Markdown(object):
                     result = '<sup class="footnote-ref" id="fnref-%s">' \
                              '<a href="#fn-%s">%s</a></sup>' \
                              % (normed_id, normed_id, len(self.footnote_ids))
-                    text = text[:start_idx] + result + text[p+1:]
-                else:
-                    # This id isn't defined, leave the markup alone.
-                    curr_pos = p+1
+                    pieces.append(text[done_pos:start_idx])
+                    pieces.append(result)
+                    done_pos = p+1
+                # Otherwise this id isn't defined, leave the markup alone.
+                curr_pos = p+1
                 continue
 
             # Now determine what this is by the remainder.
             p += 1
             if p == text_length:
-                return text
+                break
 
             # Inline anchor or img?
             if text[p] == '(': # attempt at perf improvement
-                match = self._tail_of_inline_link_re.match(text, p)
+                match = p < last_paren and self._tail_of_inline_link_re.match(text, p)
                 if match:
                     # Handle an inline anchor or img.
                     is_img = start_idx > 0 and text[start_idx-1] == "!"
@@ -1118,6 +1487,8 @@ class Markdown(object):
                     url, title = match.group("url"), match.group("title")
                     if url and url[0] == '<':
                         url = url[1:-1]  # '<url>' -> 'url'
+                    if self.safe_mode:
+                        url = self._safe_url(url)
                     # We've got to encode these to avoid conflicting
                     # with italics/bold.
                     url = url.replace('*', self._escape_table['*']) \
@@ -1136,18 +1507,14 @@ class Markdown(object):
                                title_str, self.empty_element_suffix)
                         if "smarty-pants" in self.extras:
                             result = result.replace('"', self._escape_table['"'])
-                        curr_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[match.end():]
-                    elif start_idx >= anchor_allowed_pos:
+                        pieces.append(text[done_pos:start_idx])
+                        pieces.append(result)
+                        done_pos = curr_pos = match.end()
+                    elif anchor_allowed:
                         result_head = '<a href="%s"%s>' % (url, title_str)
-                        result = '%s%s</a>' % (result_head, link_text)
-                        if "smarty-pants" in self.extras:
-                            result = result.replace('"', self._escape_table['"'])
-                        # <img> allowed from curr_pos on, <a> from
-                        # anchor_allowed_pos on.
-                        curr_pos = start_idx + len(result_head)
-                        anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[match.end():]
+                        self._add_anchor(pieces, text[done_pos:start_idx],
+                                         result_head, link_text)
+                        done_pos = curr_pos = match.end()
                     else:
                         # Anchor not allowed here.
                         curr_pos = start_idx + 1
@@ -1155,7 +1522,7 @@ class Markdown(object):
 
             # Reference anchor or img?
             else:
-                match = self._tail_of_reference_link_re.match(text, p)
+                match = p < last_bracket and self._tail_of_reference_link_re.match(text, p)
                 if match:
                     # Handle a reference-style anchor or img.
                     is_img = start_idx > 0 and text[start_idx-1] == "!"
@@ -1166,13 +1533,14 @@ class Markdown(object):
                         link_id = link_text.lower()  # for links like [this][]
                     if link_id in self.urls:
                         url = self.urls[link_id]
+                        if self.safe_mode:
+                            url = self._safe_url(url)
                         # We've got to encode these to avoid conflicting
                         # with italics/bold.
                         url = url.replace('*', self._escape_table['*']) \
                                  .replace('_', self._escape_table['_'])
                         title = self.titles.get(link_id)
                         if title:
-                            before = title
                             title = _xml_escape_attr(title) \
                                 .replace('*', self._escape_table['*']) \
                                 .replace('_', self._escape_table['_'])
@@ -1186,20 +1554,14 @@ class Markdown(object):
                                    title_str, self.empty_element_suffix)
                             if "smarty-pants" in self.extras:
                                 result = result.replace('"', self._escape_table['"'])
-                            curr_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
-                        elif start_idx >= anchor_allowed_pos:
-                            result = '<a href="%s"%s>%s</a>' \
-                                % (url, title_str, link_text)
+                            pieces.append(text[done_pos:start_idx])
+                            pieces.append(result)
+                            done_pos = curr_pos = match.end()
+                        elif anchor_allowed:
                             result_head = '<a href="%s"%s>' % (url, title_str)
-                            result = '%s%s</a>' % (result_head, link_text)
-                            if "smarty-pants" in self.extras:
-                                result = result.replace('"', self._escape_table['"'])
-                            # <img> allowed from curr_pos on, <a> from
-                            # anchor_allowed_pos on.
-                            curr_pos = start_idx + len(result_head)
-                            anchor_allowed_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
+                            self._add_anchor(pieces, text[done_pos:start_idx],
+                                             result_head, link_text)
+                            done_pos = curr_pos = match.end()
                         else:
                             # Anchor not allowed here.
                             curr_pos = start_idx + 1
@@ -1211,7 +1573,21 @@ class Markdown(object):
             # Otherwise, it isn't markup.
             curr_pos = start_idx + 1
 
-        return text
+        if not pieces:
+            return text
+        pieces.append(text[done_pos:])
+        return ''.join(pieces)
+
+    def _add_anchor(self, pieces, before, result_head, link_text):
+        """Add the text before an anchor and the anchor to `pieces`. Img
+        links are allowed in the anchor text, but not anchors."""
+        if "smarty-pants" in self.extras:
+            result_head = result_head.replace('"', self._escape_table['"'])
+            link_text = link_text.replace('"', self._escape_table['"'])
+        pieces.append(before)
+        pieces.append(result_head)
+        pieces.append(self._do_links(link_text, anchor_allowed=False))
+        pieces.append('</a>')
 
     def header_id_from_text(self, text, prefix, n):
         """Generate a header id attribute value from the given header
@@ -1331,33 +1707,8 @@ class Markdown(object):
             # types running into each other (see issue #16).
             hits = []
             for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        [ ]{0,%d}
-                        (%s)            # \3 = first list item marker
-                        [ \t]+
-                        (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \4
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
+                list_re = _list_re_from(marker_pat, self.tab_width,
+                                        bool(self.list_level))
                 match = list_re.search(text, pos)
                 if match:
                     hits.append((match.start(), match))
@@ -1429,36 +1780,11 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _pygments_lexer_from_name(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
-        import pygments
-        import pygments.formatters
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                yield 0, "<code>"
-                for tup in inner:
-                    yield tup
-                yield 0, "</code>"
-
-            def wrap(self, source, outfile):
-                """Return the source with a code, pre, and div."""
-                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
-
         formatter_opts.setdefault("cssclass", "codehilite")
-        formatter = HtmlCodeFormatter(**formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        return _highlight(codeblock, lexer, formatter_opts)
 
     def _code_block_sub(self, match, is_fenced_code_block=False):
         lexer_name = None
@@ -1512,17 +1838,7 @@ class Markdown(object):
 
     def _do_code_blocks(self, text):
         """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
-            (?:\n\n|\A\n?)
-            (               # $1 = the code block -- one or more lines, starting with a space/tab
-              (?:
-                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
-                .*\n+
-              )+
-            )
-            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
+        code_block_re = _code_block_re_from_tab_width(self.tab_width)
         return code_block_re.sub(self._code_block_sub, text)
 
     _fenced_code_block_re = re.compile(r'''
@@ -1557,6 +1873,8 @@ class Markdown(object):
             (?!`)
         ''', re.X | re.S)
 
+    _backtick_run_re = re.compile(r'`+')
+
     def _code_span_sub(self, match):
         c = match.group(2).strip(" \t")
         c = self._encode_code(c)
@@ -1585,7 +1903,41 @@ class Markdown(object):
         #       Turns to:
         #
         #         ... type <code>`bar`</code> ...
-        return self._code_span_re.sub(self._code_span_sub, text)
+
+        # Optimization.
+        if '`' not in text:
+            return text
+
+        # `_code_span_re` scans to the end of text for every backtick it
+        # fails to match at, which takes quadratic time on runs of unclosed
+        # or mismatched backticks. The rest of a run from a backtick
+        # matches if a run of the same length follows it, so the regex is
+        # only tried there.
+        runs = [m.span() for m in self._backtick_run_re.finditer(text)]
+        starts = {}
+        for start, end in runs:
+            starts.setdefault(end - start, []).append(start)
+        pieces = []
+        done_pos = 0
+        for start, end in runs:
+            if start < done_pos:
+                continue  # in the code span matched last
+            for pos in range(start, end):
+                if pos == start and text[start-1:start] == '\\':
+                    continue
+                closers = starts.get(end - pos)
+                if not closers or closers[-1] <= end:
+                    continue
+                match = self._code_span_re.match(text, pos)
+                if match is not None:
+                    pieces.append(text[done_pos:pos])
+                    pieces.append(self._code_span_sub(match))
+                    done_pos = match.end()
+                    break
+        if not pieces:
+            return text
+        pieces.append(text[done_pos:])
+        return ''.join(pieces)
 
     def _encode_code(self, text):
         """Encode/escape certain characters inside Markdown code runs.
@@ -1610,16 +1962,69 @@ class Markdown(object):
     _em_re = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
     _code_friendly_strong_re = re.compile(r"\*\*(?=\S)(.+?[*_]*)(?<=\S)\*\*", re.S)
     _code_friendly_em_re = re.compile(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
+    # The opening and the closing delimiters of the regexes above.
+    _strong_delims = (re.compile(r"(\*\*|__)(?=\S)"),
+                      re.compile(r"(?<=\S)(?=(\*\*|__))"))
+    _em_delims = (re.compile(r"(\*|_)(?=\S)"),
+                  re.compile(r"(?<=\S)(?=(\*|_))"))
+    _code_friendly_strong_delims = (re.compile(r"(\*\*)(?=\S)"),
+                                    re.compile(r"(?<=\S)(?=(\*\*))"))
+    _code_friendly_em_delims = (re.compile(r"(\*)(?=\S)"),
+                                re.compile(r"(?<=\S)(?=(\*))"))
     def _do_italics_and_bold(self, text):
+        # Optimization.
+        if '*' not in text and '_' not in text:
+            return text
+
         # <strong> must go first:
         if "code-friendly" in self.extras:
-            text = self._code_friendly_strong_re.sub(r"<strong>\1</strong>", text)
-            text = self._code_friendly_em_re.sub(r"<em>\1</em>", text)
+            text = self._sub_emphasis(self._code_friendly_strong_re,
+                self._code_friendly_strong_delims, r"<strong>\1</strong>", text)
+            text = self._sub_emphasis(self._code_friendly_em_re,
+                self._code_friendly_em_delims, r"<em>\1</em>", text)
         else:
-            text = self._strong_re.sub(r"<strong>\2</strong>", text)
-            text = self._em_re.sub(r"<em>\2</em>", text)
+            text = self._sub_emphasis(self._strong_re, self._strong_delims,
+                r"<strong>\2</strong>", text)
+            text = self._sub_emphasis(self._em_re, self._em_delims,
+                r"<em>\2</em>", text)
         return text
 
+    def _sub_emphasis(self, emphasis_re, delims, template, text):
+        """Like `emphasis_re.sub(template, text)`, but `emphasis_re` is only
+        tried at an opening delimiter with a closing one later in the text.
+
+        The regex scans to the end of text for every opening delimiter it
+        fails to match, which takes quadratic time on a text of many
+        unclosed ones. An opening delimiter always matches if the same
+        closing one follows, so the others are skipped here.
+        """
+        opening_re, closing_re = delims
+        last_closing = {}
+        for match in closing_re.finditer(text):
+            last_closing[match.group(1)] = match.start()
+        if not last_closing:
+            return text
+        pieces = []
+        done_pos = pos = 0
+        while True:
+            opening = opening_re.search(text, pos)
+            if opening is None:
+                break
+            pos = opening.start() + 1
+            # The emphasized text is one character at least.
+            if last_closing.get(opening.group(1), -1) <= opening.end():
+                continue
+            match = emphasis_re.match(text, opening.start())
+            if match is None:
+                continue
+            pieces.append(text[done_pos:match.start()])
+            pieces.append(match.expand(template))
+            done_pos = pos = match.end()
+        if not pieces:
+            return text
+        pieces.append(text[done_pos:])
+        return ''.join(pieces)
+
     # "smarty-pants" extra: Very liberal in interpreting a single prime as an
     # apostrophe; e.g. ignores the fact that "round", "bout", "twer", and
     # "twixt" can be written without an initial apostrophe. This is fine because
@@ -1773,18 +2178,24 @@ class Markdown(object):
     def _encode_amps_and_angles(self, text):
         # Smart processing for ampersands and angle brackets that need
         # to be encoded.
-        text = self._ampersand_re.sub('&amp;', text)
+        if '&' in text:
+            text = self._ampersand_re.sub('&amp;', text)
 
         # Encode naked <'s
-        text = self._naked_lt_re.sub('&lt;', text)
+        if '<' in text:
+            text = self._naked_lt_re.sub('&lt;', text)
 
         # Encode naked >'s
         # Note: Other markdown implementations (e.g. Markdown.pl, PHP
         # Markdown) don't do this.
-        text = self._naked_gt_re.sub('&gt;', text)
+        if '>' in text:
+            text = self._naked_gt_re.sub('&gt;', text)
         return text
 
     def _encode_backslash_escapes(self, text):
+        # Optimization.
+        if '\\' not in text:
+            return text
         for ch, escape in list(self._escape_table.items()):
             text = text.replace("\\"+ch, escape)
         return text
@@ -1809,6 +2220,9 @@ class Markdown(object):
             self._unescape_special_chars(match.group(1)))
 
     def _do_auto_links(self, text):
+        # Optimization.
+        if '<' not in text:
+            return text
         text = self._auto_link_re.sub(self._auto_link_sub, text)
         text = self._auto_email_link_re.sub(self._auto_email_link_sub, text)
         return text
@@ -1890,6 +2304,140 @@ class MarkdownWithExtras(Markdown):
     extras = ["footnotes", "code-color"]
 
 
+class IncrementalMarkdown(Markdown):
+    """A markdowner which caches the HTML of each top-level block, so
+    converting a document again after editing some of its blocks renders
+    only the edited ones. The output is the same as `Markdown`'s.
+
+    The text is split at the blank lines followed by a line which can't
+    continue the block before it, see `_block_start_chars`. A block is
+    keyed by its digest and the link definitions and extras of the
+    document. The numbers of footnotes and the ids of headers depend on
+    the order all blocks are processed in, so the document is converted
+    as a whole if it defines footnotes or the "header-ids" extra is used.
+    So is a document with HTML comments or block tags left in the text
+    after its HTML blocks are hashed, or in a block after the HTML made of
+    it is hashed, as they may make up an HTML block with other blocks.
+
+    >>> m = IncrementalMarkdown()
+    >>> html = m.convert(u"# Title\\n\\nfoo [a][]\\n\\nbar\\n\\n[a]: /a\\n")
+    >>> m.rendered_blocks
+    3
+    >>> m.convert(u"# Title\\n\\nfoo [a][]\\n\\nbaz\\n\\n[a]: /a\\n")
+    u'<h1>Title</h1>\\n\\n<p>foo <a href="/a">a</a></p>\\n\\n<p>baz</p>\\n'
+    >>> m.rendered_blocks
+    1
+    >>> html = m.convert(u"# Title\\n\\nfoo [a][]\\n\\nbaz\\n\\n[a]: /b\\n")
+    >>> m.rendered_blocks
+    3
+    """
+    # The boundary of blocks in the text after the link definitions are
+    # stripped.
+    _block_boundary_re = re.compile(r"\n{2,}(?=%s)" % Markdown._block_start_chars)
+    _header_tag_re = re.compile(r"h[1-6]$")
+
+    def __init__(self, max_blocks=1024, **kwargs):
+        """@param max_blocks {int} the max number of blocks cached."""
+        Markdown.__init__(self, **kwargs)
+        self.max_blocks = max_blocks
+        self._blocks = OrderedDict()
+
+    def reset(self):
+        Markdown.reset(self)
+        self.rendered_blocks = 0
+        self._tags_left = False
+
+    def _is_incremental(self, text):
+        if self._block_depth != 1 or self.list_level:
+            return False
+        if "header-ids" in self.extras or getattr(self, "footnotes", None):
+            return False
+        if "<" in text and ("<!--" in text
+                            or self._tag_block_start_re.search(text)
+                            or self._strict_tag_block_end_re.search(text)
+                            or self._liberal_tag_block_end_re.search(text)):
+            return False
+        return True
+
+    def _run_block_stages(self, text):
+        if not self._is_incremental(text):
+            return Markdown._run_block_stages(self, text)
+
+        document_key = repr((sorted(self.urls.items()),
+                             sorted(self.titles.items()),
+                             sorted(self.extras.items())))
+        grafs = []
+        for start, end in self._block_spans(text):
+            self._add_block(grafs, document_key, text[start:end])
+        if self._tags_left:
+            return Markdown._run_block_stages(self, text)
+        return "\n\n".join(grafs)
+
+    def _block_spans(self, text):
+        """Yield the (start, end) of the top-level blocks of text which
+        have content, or of the whole text if none has."""
+        fences = []
+        if "fenced-code-blocks" in self.extras and "```" in text:
+            fences = [m.span() for m in self._fenced_code_block_re.finditer(text)]
+        start = 0
+        found = False
+        for match in self._block_boundary_re.finditer(text):
+            end = match.end()
+            while fences and fences[0][1] <= end:
+                del fences[0]
+            if fences and fences[0][0] < end:
+                continue  # in a fenced code block
+            if text[start:match.start()].strip("\n"):
+                yield start, end
+                found = True
+            start = end
+        if not found or text[start:].strip("\n"):
+            yield start, len(text)
+
+    def split_blocks(self, text):
+        """Return the top-level blocks of the text, split where `convert`
+        splits it to cache their HTML. The text is prepared like for
+        `convert`: newlines normalized, tabs expanded and the link
+        definitions stripped.
+
+        >>> IncrementalMarkdown().split_blocks(u"a\\n\\n* b\\n\\n* c\\n\\nd\\n\\n[x]: /x\\n")
+        [u'a\\n\\n* b\\n\\n* c\\n\\n', u'd\\n\\n']
+        """
+        self.reset()
+        text = self._strip_link_definitions(self._prepare_block(text))
+        return [text[start:end] for start, end in self._block_spans(text)]
+
+    def _add_block(self, grafs, document_key, text):
+        key = md5((document_key + "\0" + text).encode("utf-8")).hexdigest()
+        block = self._blocks.pop(key, None)
+        if block is None:
+            self.rendered_blocks += 1
+            tags_left, self._tags_left = self._tags_left, False
+            block = (Markdown._run_block_stages(self, text), self._tags_left)
+            self._tags_left = tags_left
+        self._blocks[key] = block
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        html, tags_left = block
+        self._tags_left = self._tags_left or tags_left
+        if html:
+            grafs.append(html)
+
+    def _sub_tag_blocks(self, block_re, end_re, repl, text):
+        text = Markdown._sub_tag_blocks(self, block_re, end_re, repl, text)
+        if self._block_depth != 1 or self._tags_left:
+            return text
+        # A tag block not ended in this block may be ended in a later one
+        # when the whole document is hashed, except that the strict end
+        # of a header is never made, it's left to the liberal regex.
+        for match in self._tag_block_start_re.finditer(text):
+            if (end_re is self._liberal_tag_block_end_re
+                or not self._header_tag_re.match(match.group(1))):
+                self._tags_left = True
+                break
+        return text
+
+
 #---- internal support functions
 
 class UnicodeWithAttrs(unicode):
@@ -2140,6 +2688,167 @@ def _hr_tag_re_from_tab_width(tab_width):
         """ % (tab_width - 1), re.X)
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
+def _link_def_re_from_tab_width(tab_width):
+    """Link definition regex, like '[id]: url "optional title"'."""
+    return re.compile(r"""
+        ^[ ]{0,%d}\[(.+)\]: # id = \1
+          [ \t]*
+          \n?               # maybe *one* newline
+          [ \t]*
+        <?(.+?)>?           # url = \2
+          [ \t]*
+        (?:
+            \n?             # maybe one newline
+            [ \t]*
+            (?<=\s)         # lookbehind for whitespace
+            ['"(]
+            ([^\n]*)        # title = \3
+            ['")]
+            [ \t]*
+        )?  # title is optional
+        (?:\n+|\Z)
+        """ % (tab_width - 1), re.X | re.M | re.U)
+_link_def_re_from_tab_width = _memoized(_link_def_re_from_tab_width)
+
+def _footnote_def_re_from_tab_width(tab_width):
+    """Footnote definition regex, like '[^note-id]: Text of the note.'."""
+    return re.compile(r'''
+        ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+        [ \t]*
+        (                       # footnote text = \2
+          # First line need not start with the spaces.
+          (?:\s*.*\n+)
+          (?:
+            (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+            .*\n+
+          )*
+        )
+        # Lookahead for non-space at line-start, or end of doc.
+        (?:(?=^[ ]{0,%d}\S)|\Z)
+        ''' % (tab_width - 1, tab_width, tab_width),
+        re.X | re.M)
+_footnote_def_re_from_tab_width = _memoized(_footnote_def_re_from_tab_width)
+
+def _list_re_from(marker_pat, tab_width, sub_list):
+    """Whole list regex of the list item markers `marker_pat`."""
+    whole_list = r'''
+        (                   # \1 = whole list
+          (                 # \2
+            [ ]{0,%d}
+            (%s)            # \3 = first list item marker
+            [ \t]+
+            (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+          )
+          (?:.+?)
+          (                 # \4
+              \Z
+            |
+              \n{2,}
+              (?=\S)
+              (?!           # Negative lookahead for another list item marker
+                [ \t]*
+                %s[ \t]+
+              )
+          )
+        )
+    ''' % (tab_width - 1, marker_pat, marker_pat)
+    if sub_list:
+        return re.compile("^"+whole_list, re.X | re.M | re.S)
+    else:
+        return re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
+                          re.X | re.M | re.S)
+_list_re_from = _memoized(_list_re_from)
+
+def _code_block_re_from_tab_width(tab_width):
+    """Indented code block regex."""
+    return re.compile(r'''
+        (?:\n\n|\A\n?)
+        (               # $1 = the code block -- one or more lines, starting with a space/tab
+          (?:
+            (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
+            .*\n+
+          )+
+        )
+        ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
+        ''' % (tab_width, tab_width),
+        re.M | re.X)
+_code_block_re_from_tab_width = _memoized(_code_block_re_from_tab_width)
+
+def _pygments_lexer_from_name(lexer_name):
+    """The Pygments lexer of `lexer_name`, or None if there is no such lexer
+    or Pygments isn't installed."""
+    try:
+        from pygments import lexers, util
+    except ImportError:
+        return None
+    try:
+        return lexers.get_lexer_by_name(lexer_name)
+    except util.ClassNotFound:
+        return None
+_pygments_lexer_from_name = _memoized(_pygments_lexer_from_name)
+
+def _html_code_formatter_class():
+    """The Pygments HTML formatter class which wraps the code in <code>
+    tags."""
+    import pygments.formatters
+
+    class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+        def _wrap_code(self, inner):
+            """A function for use in a Pygments Formatter which
+            wraps in <code> tags.
+            """
+            yield 0, "<code>"
+            for tup in inner:
+                yield tup
+            yield 0, "</code>"
+
+        def wrap(self, source, outfile):
+            """Return the source with a code, pre, and div."""
+            return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
+
+    return HtmlCodeFormatter
+_html_code_formatter_class = _memoized(_html_code_formatter_class)
+
+def _html_code_formatter_from_opts(*formatter_opts):
+    """The formatter of the (name, value) pairs of `formatter_opts`."""
+    return _html_code_formatter_class()(**dict(formatter_opts))
+_html_code_formatter_from_opts = _memoized(_html_code_formatter_from_opts)
+
+# The max number of highlighted code blocks kept by `_highlight`.
+HIGHLIGHT_CACHE_SIZE = 256
+
+_highlight_cache = OrderedDict()
+_highlight_cache_lock = threading.Lock()
+
+def _highlight(codeblock, lexer, formatter_opts):
+    """Highlight the code block by Pygments, the result is kept in a LRU
+    cache keyed by the digest of the code block, the lexer and the
+    formatter options."""
+    import pygments
+
+    formatter_opts = tuple(sorted(formatter_opts.items()))
+    try:
+        key = (md5(codeblock.encode("utf-8")).hexdigest(), type(lexer),
+               formatter_opts)
+        hash(key)
+    except TypeError:
+        # uncachable options, like a list of `hl_lines`.
+        key = None
+    if key is not None:
+        with _highlight_cache_lock:
+            colored = _highlight_cache.pop(key, None)
+            if colored is not None:
+                _highlight_cache[key] = colored
+                return colored
+    formatter = _html_code_formatter_from_opts(*formatter_opts)
+    colored = pygments.highlight(codeblock, lexer, formatter)
+    if key is not None:
+        with _highlight_cache_lock:
+            _highlight_cache[key] = colored
+            while len(_highlight_cache) > HIGHLIGHT_CACHE_SIZE:
+                _highlight_cache.popitem(last=False)
+    return colored
+
 
 def _xml_escape_attr(attr, skip_single_quote=True):
     """Escape the given string for use in an HTML/XML tag attribute.
@@ -2214,6 +2923,9 @@ def main(argv=None):
                            "<https://github.com/trentm/python-markdown2/wiki/Extras>")
     parser.add_option("--link-patterns-file",
                       help="path to a link pattern file")
+    parser.add_option("--stream", action="store_true",
+                      help="convert the files block by block in bounded "
+                           "memory, see `Markdown.convert_stream`")
     parser.add_option("--self-test", action="store_true",
                       help="run internal self-tests (some doctests)")
     parser.add_option("--compare", action="store_true",
@@ -2268,6 +2980,21 @@ def main(argv=None):
     if not paths:
         paths = ['-']
     for path in paths:
+        if opts.stream and path != '-':
+            fp = codecs.open(path, 'r', opts.encoding)
+            try:
+                for html in markdown_stream(fp,
+                        html4tags=opts.html4tags,
+                        safe_mode=opts.safe_mode,
+                        extras=extras, link_patterns=link_patterns):
+                    if py3:
+                        sys.stdout.write(html)
+                    else:
+                        sys.stdout.write(html.encode(
+                            sys.stdout.encoding or "utf-8", 'xmlcharrefreplace'))
+            finally:
+                fp.close()
+            continue
         if path == '-':
             text = sys.stdin.read()
         else:
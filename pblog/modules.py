@@ -4,6 +4,21 @@
 import time
 from core.orm import *
 from core.db import next_id
+from render import render_blog, RENDERER_VERSION
+
+# The functions called after a blog or comment is changed, like dropping the
+# cached pages, added by the web layer so the models don't depend on it.
+_change_listeners = []
+
+def add_change_listener(func):
+    """Call `func` with no arguments after a blog or comment is inserted,
+    updated or deleted. It can be used as a decorator."""
+    _change_listeners.append(func)
+    return func
+
+def _changed(self):
+    for func in _change_listeners:
+        func()
 
 class User(Model):
     __table__='users'
@@ -30,6 +45,41 @@ class Blog(Model):
     read_count = IntegerField(default=0)
     category = StringField(max_length=50)
     tags = StringField(max_length=50)
+    # the HTML of content rendered on write by the renderer of version, and
+    # the by-products of rendering it, see `render.blog_meta`.
+    content_html = TextField()
+    renderer_version = IntegerField(default=0)
+    toc_html = TextField()
+    word_count = IntegerField(default=0)
+    reading_time = IntegerField(default=0)
+    first_image = StringField(max_length=500)
+    excerpt_html = TextField()
+
+    # the columns read by list views, without the content and its HTML.
+    LIST_FIELDS = 'id, user_id, user_name, user_image, name, summary, created_at, ' \
+        'read_count, category, tags, renderer_version, word_count, reading_time, ' \
+        'first_image, excerpt_html'
+
+    def pre_insert(self):
+        meta = render_blog(self.content)
+        self.content_html = meta.html
+        self.toc_html = meta.toc_html
+        self.word_count = meta.word_count
+        self.reading_time = meta.reading_time
+        self.first_image = meta.first_image
+        self.excerpt_html = meta.excerpt_html
+        self.renderer_version = RENDERER_VERSION
+
+    pre_update = pre_insert
+
+    def html(self):
+        """Return the HTML of content, it is rendered now if the stored one
+        is made by an old renderer."""
+        if self.renderer_version != RENDERER_VERSION:
+            return render_blog(self.content).html
+        return self.content_html
+
+    post_insert = post_update = post_delete = _changed
 
 class Comment(Model):
     __table__ = 'comments'
@@ -41,3 +91,5 @@ class Comment(Model):
     user_image = StringField(max_length=50)
     content = TextField()
     created_at = FloatField(updatable=False, default=time.time)
+
+    post_insert = post_update = post_delete = _changed
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Rendering of the markdown content to HTML."""
+
+__author__="Wenjun Xiao"
+
+import os, re, cgi, math, hashlib, logging, threading
+from HTMLParser import HTMLParser
+from collections import OrderedDict
+import markdown2
+from core.utils import Dict
+
+# Bump it when the output of `render_markdown` changes, e.g. markdown2 is
+# upgraded or the extras are changed, then run 'scripts/backfill_html.py'
+# to render the stored HTML of blogs again. The HTML of `MarkdownCache` is
+# keyed on it too.
+RENDERER_VERSION = 3
+
+# The words read in a minute for the reading time of blogs, a CJK character
+# is counted as a word.
+WORDS_PER_MINUTE = 300
+
+def _options_key(extras, safe_mode, tab_width):
+    if isinstance(extras, dict):
+        extras = sorted(extras.items())
+    elif extras:
+        extras = sorted(extras)
+    return repr((extras or None, safe_mode, tab_width))
+
+_converters = threading.local()
+
+def get_converter(extras=None, safe_mode=None, tab_width=4, bounded=False,
+    incremental=False):
+    """Return the `markdown2.Markdown` of the options owned by the current
+    thread. It is made once per thread and reused, `convert` resets its
+    state before converting. A `bounded` one has the 'max_input_size' and
+    'time_limit' of 'MARKDOWN_LIMITS' in settings, and records the time
+    of its stages. An `incremental` one is a `markdown2.IncrementalMarkdown`
+    made by 'MARKDOWN_INCREMENTAL' in settings, if it is set.
+
+    >>> get_converter() is get_converter()
+    True
+    >>> get_converter() is get_converter(safe_mode='escape')
+    False
+    >>> get_converter(['footnotes']) is get_converter(('footnotes',))
+    True
+    """
+    key = (_options_key(extras, safe_mode, tab_width), bounded, incremental)
+    registry = getattr(_converters, 'registry', None)
+    if registry is None:
+        registry = _converters.registry = {}
+    converter = registry.get(key)
+    if converter is None:
+        from core.conf import settings
+        cls, conf = markdown2.Markdown, {}
+        if bounded:
+            conf = dict(settings.get('MARKDOWN_LIMITS') or {}, collect_timings=True)
+        if incremental and settings.get('MARKDOWN_INCREMENTAL'):
+            cls = markdown2.IncrementalMarkdown
+            conf.update(settings.get('MARKDOWN_INCREMENTAL'))
+        converter = registry[key] = cls(extras=extras, safe_mode=safe_mode,
+            tab_width=tab_width, **conf)
+    return converter
+
+def plain_html(text):
+    """Return the text as escaped paragraphs, the fallback HTML of markdown
+    out of the limits.
+
+    >>> plain_html(u'<b>hi</b>\\nthere\\n\\nbye')
+    u'<p>&lt;b&gt;hi&lt;/b&gt;<br />\\nthere</p>\\n\\n<p>bye</p>\\n'
+    """
+    paragraphs = [p.strip() for p in text.replace('\r\n', '\n').split('\n\n')]
+    return u''.join(u'<p>%s</p>\n\n' % cgi.escape(p).replace('\n', '<br />\n')
+        for p in paragraphs if p)[:-1]
+
+def render_markdown(text):
+    """Render the markdown text to HTML. The blocks of text are cached by
+    the incremental converter, so rendering a long blog again after editing
+    it renders only the edited blocks.
+
+    >>> render_markdown(u'*boo!*')
+    u'<p><em>boo!</em></p>\\n'
+    """
+    return get_converter(incremental=True).convert(text)
+
+def render_markdown_many(texts):
+    """Render a batch of markdown texts to HTML like `render_markdown`, in
+    the process pool of 'MARKDOWN_POOL' in settings if the batch is at least
+    'min_batch' texts.
+
+    >>> render_markdown_many([u'*a*', u'b'])
+    [u'<p><em>a</em></p>\\n', u'<p>b</p>\\n']
+    """
+    from core.conf import settings
+    conf = dict(settings.get('MARKDOWN_POOL') or {})
+    texts = list(texts)
+    if not conf or len(texts) < conf.pop('min_batch', 1):
+        return [render_markdown(text) for text in texts]
+    return markdown2.convert_many(texts, **conf)
+
+# The excerpt of a blog shown by list pages is the text before MORE_MARKER,
+# or else its first EXCERPT_BLOCKS blocks.
+MORE_MARKER = u'<!--more-->'
+EXCERPT_BLOCKS = 3
+
+def excerpt_markdown(text, max_blocks=EXCERPT_BLOCKS):
+    """Return the markdown of the excerpt of a blog, with the link
+    definitions of the rest of it, so the references in the excerpt are
+    still links. The blocks are split where `render_markdown` splits them.
+
+    >>> excerpt_markdown(u'a [b][]\\n\\nc\\n\\nd\\n\\n[b]: /b\\n', max_blocks=2)
+    u'a [b][]\\n\\nc\\n\\n[b]: /b\\n'
+    >>> excerpt_markdown(u'a\\n<!--more-->\\nb\\n')
+    u'a\\n\\n'
+    """
+    if MORE_MARKER in text:
+        head, rest = text.split(MORE_MARKER, 1)
+    else:
+        # the blocks have the link definitions stripped.
+        head = u''.join(markdown2.split_blocks(text)[:max_blocks])
+        rest = text
+    link_def_re = markdown2._link_def_re_from_tab_width(4)
+    return u''.join([head.rstrip(), u'\n\n'] +
+        [m.group(0) for m in link_def_re.finditer(rest)])
+
+_header_re = re.compile(r'<h([1-6])>(.*?)</h\1>', re.S)
+_tag_re = re.compile(r'<[^>]*>')
+_entity_re = re.compile(r'&#?\w+;')
+_word_re = re.compile(u'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]'
+    u'|[^\\W\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+', re.U)
+_img_src_re = re.compile(r"""<img\b[^>]*?\ssrc=(["'])(.*?)\1""", re.S)
+
+def blog_meta(html):
+    """Return the HTML of a blog with ids added to its headers, and the
+    by-products shown by sidebars and list pages without rendering it again:
+    the HTML of its table of contents, its word count, reading time in
+    minutes and the src of its first image, unescaped.
+
+    >>> meta = blog_meta(u'<h1>Intro</h1>\\n<p>Hello <img src="/a.png" /> \u4f60\u597d</p>\\n<h2>Intro</h2>\\n')
+    >>> meta.html
+    u'<h1 id="intro">Intro</h1>\\n<p>Hello <img src="/a.png" /> \\u4f60\\u597d</p>\\n<h2 id="intro-2">Intro</h2>\\n'
+    >>> print meta.toc_html,
+    <ul>
+      <li><a href="#intro">Intro</a>
+      <ul>
+        <li><a href="#intro-2">Intro</a></li>
+      </ul></li>
+    </ul>
+    >>> meta.word_count, meta.reading_time, meta.first_image
+    (5, 1, u'/a.png')
+    """
+    toc, counts = [], {}
+    def add_id(m):
+        name = _entity_re.sub('', _tag_re.sub('', m.group(2)))
+        header_id = markdown2._slugify(name) or 'section'
+        counts[header_id] = counts.get(header_id, 0) + 1
+        if counts[header_id] > 1:
+            header_id += '-%d' % counts[header_id]
+        toc.append((int(m.group(1)), header_id, m.group(2)))
+        return '<h%s id="%s">%s</h%s>' % (m.group(1), header_id, m.group(2), m.group(1))
+    html = _header_re.sub(add_id, html)
+    toc_html = markdown2.UnicodeWithAttrs()
+    toc_html._toc = toc
+    words = len(_word_re.findall(_entity_re.sub(' ', _tag_re.sub(' ', html))))
+    # the src longer than the column of blogs, like data URIs, is skipped.
+    image = _img_src_re.search(html)
+    if image and len(image.group(2)) > 500:
+        image = None
+    return Dict(html=html, toc_html=toc_html.toc_html if toc else u'',
+        word_count=words,
+        reading_time=int(math.ceil(float(words) / WORDS_PER_MINUTE)),
+        first_image=HTMLParser().unescape(image.group(2)) if image else u'')
+
+def render_blog(text):
+    """Render the markdown of a blog like `render_markdown`, and return it
+    with the by-products of `blog_meta` and the HTML of its excerpt.
+
+    >>> render_blog(u'a\\n\\n<!--more-->\\n\\nb').excerpt_html
+    u'<p>a</p>\\n'
+    """
+    return render_blog_many([text])[0]
+
+def render_blog_many(texts):
+    """Render a batch of markdown of blogs like `render_blog`, see
+    `render_markdown_many`."""
+    texts = list(texts)
+    htmls = render_markdown_many([text.replace(MORE_MARKER, u'') for text in texts] +
+        [excerpt_markdown(text) for text in texts])
+    metas = [blog_meta(html) for html in htmls[:len(texts)]]
+    for meta, excerpt_html in zip(metas, htmls[len(texts):]):
+        meta.excerpt_html = excerpt_html
+    return metas
+
+# Touches every block and span rule, so their regexes are compiled by
+# `warm_up`.
+_WARM_UP_TEXT = u"""\
+Title
+=====
+
+## Header ##
+
+<div>
+html block
+</div>
+
+<hr />
+
+<!-- comment -->
+
+* item *em*
+* item **strong**
+
+    * sub item
+
+1. one
+2. two
+
+    code block
+
+> quote `code`
+
+[link][id], [inline](http://example.com/ "title"), ![img](/a.png),
+<http://example.com/> and <me@example.com> & <span>span</span>.
+
+---
+
+[id]: http://example.com/  "Title"
+"""
+
+def warm_up():
+    """Make the converters of current thread and compile the regexes they
+    use, so the first request isn't the slow one. It is the initializer of
+    worker threads set in 'WORKER_INIT' of settings.
+
+    >>> warm_up()
+    """
+    render_markdown(_WARM_UP_TEXT)
+    get_converter(safe_mode='escape', bounded=True).convert(_WARM_UP_TEXT)
+
+class MarkdownCache(object):
+    """A LRU cache of the HTML converted by `markdown2.markdown`, bounded by
+    the total bytes of HTML and keyed on the digest of text and options,
+    `RENDERER_VERSION` and the version of markdown2, so the HTML made by an
+    old renderer is never served. The HTML is also kept in files under
+    `disk_dir` if given, which is read when the memory misses. The files are
+    never evicted, the ones of old versions have to be removed by hand.
+
+    Args::
+        max_bytes: the max total bytes of cached HTML in memory.
+        disk_dir: the directory of the disk tier, None to disable it.
+
+    >>> cache = MarkdownCache(max_bytes=50)
+    >>> cache.markdown(u'*boo!*')
+    u'<p><em>boo!</em></p>\\n'
+    >>> cache.markdown(u'*boo!*', safe_mode='escape')
+    u'<p><em>boo!</em></p>\\n'
+    >>> cache.markdown(u'*boo!*') is cache.markdown(u'*boo!*')
+    True
+    >>> s = cache.stats()
+    >>> s.hits, s.misses, s.evictions, s.entries
+    (2, 2, 0, 2)
+    >>> html = cache.markdown(u'*hi!*')
+    >>> s = cache.stats()
+    >>> s.evictions, s.entries, s.bytes <= 50
+    (1, 2, True)
+    """
+
+    def __init__(self, max_bytes=4 * 1024 * 1024, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _digest(self, text, options):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return hashlib.sha1('%s\0%s\0%s\0%s' % (RENDERER_VERSION,
+            markdown2.__version__, options, text)).hexdigest()
+
+    def _disk_path(self, digest):
+        return os.path.join(self.disk_dir, digest[:2], digest[2:] + '.html')
+
+    def _read_disk(self, digest):
+        try:
+            with open(self._disk_path(digest), 'rb') as f:
+                return f.read().decode('utf-8')
+        except (IOError, OSError):
+            return None
+
+    def _write_disk(self, digest, html):
+        fpath = self._disk_path(digest)
+        try:
+            if not os.path.isdir(os.path.dirname(fpath)):
+                os.makedirs(os.path.dirname(fpath))
+            tmp = '%s.tmp%d' % (fpath, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(html.encode('utf-8'))
+            os.rename(tmp, fpath)
+        except (IOError, OSError):
+            pass
+
+    def markdown(self, text, extras=None, safe_mode=None, tab_width=4,
+        bounded=False):
+        """Convert the markdown text to HTML like `markdown2.markdown`, the
+        HTML of same text and options is converted only once. If `bounded`,
+        the text out of the limits is rendered by `plain_html` and isn't
+        cached, see `get_converter`."""
+        digest = self._digest(text, _options_key(extras, safe_mode, tab_width))
+        with self._lock:
+            html = self._entries.pop(digest, None)
+            if html is not None:
+                self._entries[digest] = html
+                self._hits += 1
+                return html
+        html = self._read_disk(digest) if self.disk_dir else None
+        if html is not None:
+            with self._lock:
+                self._disk_hits += 1
+        else:
+            converter = get_converter(extras, safe_mode, tab_width, bounded)
+            try:
+                html = converter.convert(text)
+            except markdown2.MarkdownLimitError as e:
+                logging.warning('render %d characters of markdown as plain text: '
+                    '%s, stage times: %s', len(text), e, converter.stage_times)
+                return plain_html(text)
+            with self._lock:
+                self._misses += 1
+            if self.disk_dir:
+                self._write_disk(digest, html)
+        self._add(digest, html)
+        return html
+
+    def _add(self, digest, html):
+        nbytes = len(html.encode('utf-8'))
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(digest, None)
+            if old is not None:
+                self._bytes -= len(old.encode('utf-8'))
+            self._entries[digest] = html
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self._bytes -= len(old.encode('utf-8'))
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return Dict(entries=len(self._entries), bytes=self._bytes,
+                max_bytes=self.max_bytes, hits=self._hits, disk_hits=self._disk_hits,
+                misses=self._misses, evictions=self._evictions)
+
+_markdown_cache = None
+
+def markdown_cache():
+    """Return the shared `MarkdownCache` made by 'MARKDOWN_CACHE' in
+    settings."""
+    global _markdown_cache
+    if _markdown_cache is None:
+        from core.conf import settings
+        _markdown_cache = MarkdownCache(**dict(settings.get('MARKDOWN_CACHE') or {}))
+    return _markdown_cache
+
+def cached_markdown(text, extras=None, safe_mode=None, tab_width=4,
+    bounded=False):
+    """Convert the markdown text to HTML by the shared `markdown_cache()`,
+    for the content not stored rendered, like comments and previews."""
+    return markdown_cache().markdown(text, extras=extras, safe_mode=safe_mode,
+        tab_width=tab_width, bounded=bounded)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -13,6 +13,13 @@ LOG_CONFIG = os.path.join(BASE_DIR, "conf/logging.conf")
 
 TEMPLATE_ENGINE = 'pblog.core.templating.jinja2_engine'
 
+# Directory of the compiled templates shared by processes, remove it to
+# compile templates in every process.
+TEMPLATE_BYTECODE_CACHE = os.path.join(BASE_DIR, 'cache', 'jinja2')
+
+# Bytes of a chunk sent by the views rendered with `view(..., stream=True)`.
+TEMPLATE_STREAM_CHUNK_SIZE = 8192
+
 DATABASES = {
     'default': {
         'ENGINE': 'pblog.core.db.mysql',
@@ -26,4 +33,83 @@ DATABASES = {
 
 SESSION = {
     "secret": "PrOmIsSiNg"
-}
\ No newline at end of file
+}
+
+# Built-in server used by `application.run()`, mode can be 'simple',
+# 'threadpool' or 'eventloop'.
+SERVER = {
+    'mode': 'simple',
+    'workers': 10,
+    'queue_size': 40,
+    'retry_after': 1,
+    # seconds to keep an idle HTTP/1.1 connection open, not used by 'simple'.
+    'idle_timeout': 5,
+}
+
+# Functions, or their dotted names, called once in every worker thread of
+# the built-in server before it handles requests.
+WORKER_INIT = (
+    'pblog.render.warm_up',
+)
+
+# In-memory cache of small static files served in debug mode, remove it to
+# read files from disk on every request.
+STATIC_CACHE = {
+    'max_bytes': 8 * 1024 * 1024,
+    'max_file_size': 512 * 1024,
+    'check_interval': 2,
+}
+
+# Cache the pages of anonymous visitors for 'ttl' seconds, and serve them
+# stale for 'stale' seconds more while rebuilding, remove it to disable.
+PAGE_CACHE = {
+    'ttl': 60,
+    'stale': 30,
+    'max_entries': 1000,
+}
+
+# Cache the fragments of '{% cache key, ttl %}' tag for 'ttl' seconds by
+# default.
+FRAGMENT_CACHE = {
+    'ttl': 300,
+    'max_entries': 1000,
+}
+
+# Cache the HTML of markdown not stored rendered, like comments, in memory
+# and in files under 'disk_dir' if given, e.g. os.path.join(BASE_DIR,
+# 'cache', 'markdown'). The files are never evicted.
+MARKDOWN_CACHE = {
+    'max_bytes': 4 * 1024 * 1024,
+    'disk_dir': None,
+}
+
+# Bounds of rendering the markdown of user input, like comments, the text
+# larger than 'max_input_size' characters, nested deeper than 'max_nesting'
+# or taking longer than 'time_limit' seconds is rendered as plain text.
+MARKDOWN_LIMITS = {
+    'max_input_size': 16 * 1024,
+    'max_nesting': 32,
+    'time_limit': 0.5,
+}
+
+# Render blogs by the converter caching the HTML of at most 'max_blocks'
+# top-level blocks per thread, so saving a long blog after editing it
+# renders only the edited blocks. Remove it to render blogs as a whole.
+MARKDOWN_INCREMENTAL = {
+    'max_blocks': 1024,
+}
+
+# Render batches of at least 'min_batch' markdown texts, like blogs rendered
+# by the backfill, in a pool of 'workers' processes, the number of CPUs if
+# None. Remove it to render them in the calling thread.
+MARKDOWN_POOL = {
+    'workers': None,
+    'min_batch': 8,
+}
+
+# Compress the responses of compressible types by gzip or deflate, remove it
+# when a front proxy compresses them.
+COMPRESSION = {
+    'min_size': 1024,
+    'level': 6,
+}
@@ -3,16 +3,24 @@
 
 __author__="Wenjun Xiao"
 
-import os, re, time, base64, hashlib, logging
-
-import markdown2
-
-from core.webapi import get, post, interceptor, ModelAndView, view, ctx, jsonbody, REQ_GET
-from modules import User, Blog, Comment
+import os, re, time, json, base64, hashlib, logging
+
+from core.webapi import get, post, interceptor, ModelAndView, view, ctx, jsonbody, etag, cache_page, \
+    invalidate_pages, REQ_GET
+from core.db import execute_update
+from core.templating import jinja2_engine, fragment_cache
+from modules import User, Blog, Comment, add_change_listener
+from render import cached_markdown
 from core.conf import settings
 from apis import Page, api, APIError, APIPermissionError, APIValueError, APIResourceNotFoundError
 from core.http import forbidden, seeother, notfound
 
+@add_change_listener
+def _invalidate_caches():
+    """Drop the cached pages and sidebar when a blog or comment changes."""
+    invalidate_pages()
+    fragment_cache.invalidate('sidebar')
+
 _COOKIE_NAME = 'pblogsession'
 _COOKIE_KEY = settings.session.secret
 PROJECTS = Blog(id='projects', url='/projects/', category=u'开源项目')
@@ -70,30 +78,40 @@ def _get_page_index():
 def _get_blogs_by_page(**kwargs):
     total = Blog.count_all()
     page = Page(total, _get_page_index())
-    blogs = Blog.find_by(order='created_at desc', offset=page.offset, limit=page.limit, **kwargs)
+    blogs = Blog.find_by(what=Blog.LIST_FIELDS, order='created_at desc', offset=page.offset,
+        limit=page.limit, **kwargs)
     return blogs, page
 
+@cache_page()
+@etag
 @view('index.html')
 @get('/')
 def index():
     blogs, page = _get_blogs_by_page()
     return dict(page=page, blogs=blogs, user=ctx.request.user)
 
+@cache_page()
+@etag
 @view('index.html')
 @get('/category/:category')
 def get_category(category):
     blogs, page = _get_blogs_by_page(category=category)
     return dict(page=page, blogs=blogs, user=ctx.request.user, category=category)
 
-@view('blog.html')
+@interceptor('/blog/')
+def read_count_interceptor(next, blog_id):
+    # count the read even if the page is cached, without invalidating pages.
+    execute_update('update blogs set read_count = read_count + 1 where id = %s', blog_id)
+    return next(blog_id)
+
+@cache_page()
+@view('blog.html', stream=True)
 @get('/blog/:blog_id')
 def get_blog(blog_id):
     blog = Blog.get(blog_id)
     if blog is None:
         raise notfound()
-    blog.read_count = blog.read_count + 1
-    blog.update()
-    blog.html_content = markdown2.markdown(blog.content)
+    blog.html_content = blog.html()
     comments = Comment.find_by(order='created_at desc', limit=1000, blog_id=blog_id)
     return dict(blog=blog, comments=comments, user=ctx.request.user,category=blog.category)
 
@@ -199,11 +217,7 @@ def manage_comment_list():
 @api
 @get('/api/blogs')
 def api_blogs():
-    format = ctx.request.get('format', '')
     blogs, page = _get_blogs_by_page()
-    if format=='html':
-        for blog in blogs:
-            blog.content = markdown2.markdown(blog.content)
     return dict(blogs=blogs, page=page)
 
 @jsonbody
@@ -286,6 +300,9 @@ def api_comment_blog(blog_id):
     content = ctx.request.input(content='').content.strip()
     if not content:
         raise APIValueError('content')
+    max_size = (settings.get('MARKDOWN_LIMITS') or {}).get('max_input_size')
+    if max_size and len(content) > max_size:
+        raise APIValueError('content', 'content cannot be longer than %d characters.' % max_size)
     c = Comment(blog_id=blog_id, user_id=user.id, user_name=user.name, user_image=user.image, content=content)
     c.insert()
     return dict(comment=c)
@@ -294,7 +311,7 @@ def api_comment_blog(blog_id):
 @api
 @get('/api/blogs/top/:limit')
 def api_blogs_top(limit):
-    blogs = Blog.find_by(order='read_count desc', limit=limit);
+    blogs = Blog.find_by(what=Blog.LIST_FIELDS, order='read_count desc', limit=limit);
     return dict(blogs=blogs)
 
 @jsonbody
@@ -334,6 +351,22 @@ def api_comments_top(limit):
             comment.blog_url = PROJECTS.url
     return dict(comments=comments)
 
+def sidebar_json():
+    """The data of sidebar widgets as JSON, it is rendered in the fragment of
+    '__content__.html' cached until a blog or comment changes."""
+    app = ctx.application
+    rv = {}
+    for path in ('blogs/top/10', 'categories', 'comments/top/10'):
+        rv.update(app.internal_route(REQ_GET, '/api/%s' % path))
+    return json.dumps(rv).replace('</', '<\\/')
+
+jinja2_engine.add_global('sidebar_json', sidebar_json)
+# render the markdown of user input, like comments, in safe mode which
+# escapes the raw HTML and drops the unsafe URLs, e.g.
+# '{{ comment.content|markdown|safe }}'.
+jinja2_engine.add_filter('markdown', lambda text: cached_markdown(text,
+    safe_mode='escape', bounded=True))
+
 @jsonbody
 @api
 @get('/api/')
@@ -346,6 +379,8 @@ def api_multi_query():
         rv.update(data)
     return rv
 
+@cache_page()
+@etag
 @view('projects.html')
 @get('/projects/')
 def get_projects():
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""Render the stored HTML of blogs made by an old renderer again, or all of
+them with '--all', with its table of contents, word count, reading time,
+first image and excerpt."""
+
+__author__="Wenjun Xiao"
+
+import sys,os
+
+sys.path.append('../')
+
+from pblog import settings
+from pblog.core import db
+from pblog.render import render_blog_many, RENDERER_VERSION
+
+BATCH_SIZE = 100
+
+force = '--all' in sys.argv[1:]
+offset = count = 0
+while True:
+    rows = db.select('blogs', what='id, content, renderer_version', order='id',
+        limit=BATCH_SIZE, offset=offset)
+    if not rows:
+        break
+    offset += len(rows)
+    rows = [row for row in rows if force or row.renderer_version != RENDERER_VERSION]
+    for row, meta in zip(rows, render_blog_many([row.content for row in rows])):
+        db.update('blogs', where=[('id', row.id)], content_html=meta.html,
+            toc_html=meta.toc_html, word_count=meta.word_count,
+            reading_time=meta.reading_time, first_image=meta.first_image,
+            excerpt_html=meta.excerpt_html,
+            renderer_version=RENDERER_VERSION)
+        count += 1
+print 'rendered %d of %d blogs by renderer version %d' % (count, offset, RENDERER_VERSION)
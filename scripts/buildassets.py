@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""Build the fingerprinted static assets and their manifest for deployment."""
+
+__author__="Wenjun Xiao"
+
+import sys,os
+
+sys.path.append('../')
+
+from pblog import settings
+from pblog.core.static import build_assets
+
+clean = '--clean' in sys.argv[1:]
+manifest = build_assets(os.path.join(settings.document_root, 'static'), clean=clean)
+for name in sorted(manifest):
+    print '%s -> %s' % (name, manifest[name])
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""Benchmark markdown conversion on a corpus of short comments, long
+technical posts, link-heavy posts and adversarial inputs.
+
+It reports the throughput, the peak memory and the time of the stages of
+`Markdown.convert` and of the steps of the block and span gamuts for each
+case, and compares them with the baseline file. It exits with 1 if a case
+is slower or takes more memory than the baseline times the threshold.
+
+Usage: python markdown_bench.py [--save] [--threshold=1.5] [--baseline=path]
+
+With '--save', the results are saved as the baseline instead.
+"""
+
+__author__="Wenjun Xiao"
+
+import sys, os, time, json, random, resource, multiprocessing
+
+sys.path.append('../pblog')
+
+import markdown2
+from markdown_fuzz import PATHOLOGICAL
+
+# Each case is converted in ROUNDS rounds of at least ROUND_SECONDS, the
+# best time of converting it once is reported.
+ROUNDS = 5
+ROUND_SECONDS = 0.25
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'markdown_bench.json')
+
+# The steps of `_run_block_gamut` and `_run_span_gamut` timed, the time of a
+# step excludes the steps called by it, e.g. the items of a list.
+STEPS = ['_run_block_gamut', '_do_headers', '_do_lists', '_do_code_blocks',
+    '_do_block_quotes', '_hash_html_blocks', '_form_paragraphs', '_run_span_gamut',
+    '_do_code_spans', '_escape_special_chars', '_do_links', '_do_auto_links',
+    '_encode_amps_and_angles', '_do_italics_and_bold']
+
+WORDS = ('the of and to in is that for it as with was on be by this are from '
+    'markdown render python cache block span thread request blog comment').split()
+
+def _sentence(rnd):
+    words = [rnd.choice(WORDS) for i in range(rnd.randint(6, 18))]
+    i = rnd.randrange(len(words))
+    words[i] = rnd.choice(['*%s*', '**%s**', '`%s`', '%s']) % words[i]
+    return ' '.join(words).capitalize() + '.'
+
+def _paragraph(rnd):
+    return ' '.join(_sentence(rnd) for i in range(rnd.randint(2, 6)))
+
+def comments(rnd):
+    return [_paragraph(rnd) for i in range(200)]
+
+def technical_post(rnd):
+    parts = []
+    for i in range(40):
+        parts.append('## Section %d\n' % i)
+        parts.append(_paragraph(rnd))
+        parts.append('\n'.join('* %s' % _sentence(rnd) for j in range(4)))
+        parts.append('\n'.join('    %s' % line for line in [
+            'def render(text, cache={}):',
+            '    if text not in cache:',
+            '        cache[text] = convert(text) # <b>%d</b> & co' % i,
+            '    return cache[text]']))
+        parts.append('<table>\n<tr><th>name</th><th>time</th></tr>\n%s\n</table>' % '\n'.join(
+            '<tr><td>%s</td><td>%d</td></tr>' % (rnd.choice(WORDS), j) for j in range(5)))
+        parts.append('> %s\n> %s' % (_sentence(rnd), _sentence(rnd)))
+    return ['\n\n'.join(parts)]
+
+def link_post(rnd):
+    parts, defs = [], []
+    for i in range(300):
+        parts.append('See [%s](http://example.com/%d "title %d"), [%s][ref%d], '
+            '![img %d](/img/%d.png) and <http://example.com/auto/%d>. %s' % (
+            rnd.choice(WORDS), i, i, rnd.choice(WORDS), i, i, i, i, _sentence(rnd)))
+        defs.append('[ref%d]: http://example.com/ref/%d "Ref %d"' % (i, i, i))
+    return ['\n\n'.join(parts + defs)]
+
+def adversarial(rnd):
+    return [make(2000) for name, make in sorted(PATHOLOGICAL.items())]
+
+CASES = [
+    ('comments', comments, {'safe_mode': 'escape'}),
+    ('technical post', technical_post, {}),
+    ('link post', link_post, {}),
+    ('adversarial', adversarial, {}),
+]
+
+def _time_steps(converter, times):
+    """Wrap the `STEPS` of converter to add their exclusive time to `times`."""
+    stack = [0.0]
+    def timed(name, method):
+        def wrapper(*args, **kwargs):
+            stack.append(0.0)
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                times[name] = times.get(name, 0.0) + elapsed - stack.pop()
+                stack[-1] += elapsed
+        return wrapper
+    for name in STEPS:
+        setattr(converter, name, timed(name, getattr(converter, name)))
+
+def run_case(name, make, options, queue):
+    texts = make(random.Random(name))
+    nbytes = sum(len(text.encode('utf-8')) for text in texts)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    converter = markdown2.Markdown(collect_timings=True, **options)
+    start = time.time()
+    for text in texts:
+        converter.convert(text)
+    number = int(ROUND_SECONDS / (time.time() - start)) + 1
+    best, stages = None, {}
+    for i in range(ROUNDS):
+        start = time.time()
+        for j in range(number):
+            for text in texts:
+                converter.convert(text)
+                for stage, t in converter.stage_times.items():
+                    stages[stage] = stages.get(stage, 0.0) + t
+        seconds = (time.time() - start) / number
+        best = seconds if best is None else min(best, seconds)
+    steps = {}
+    _time_steps(converter, steps)
+    for text in texts:
+        converter.convert(text)
+    queue.put(dict(name=name, bytes=nbytes, seconds=best,
+        mb_per_s=nbytes / best / 1024 / 1024,
+        peak_mb=(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024.0,
+        stages=stages, steps=steps))
+
+def run():
+    """Run each case in a process of its own, so its peak memory is its own."""
+    results = []
+    for name, make, options in CASES:
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=run_case, args=(name, make, options, queue))
+        p.start()
+        results.append(queue.get())
+        p.join()
+    return results
+
+def report(results, baseline, threshold):
+    """Print the results and return the names of the cases regressed."""
+    regressed = []
+    print '%-16s %9s %9s %9s %9s %9s' % ('case', 'KB', 'seconds', 'MB/s', 'peak MB', 'vs base')
+    for r in results:
+        base = baseline.get(r['name'])
+        ratio = ''
+        if base:
+            ratio = r['seconds'] / base['seconds']
+            # the peak memory under 1MB is noise.
+            memory = max(r['peak_mb'], 1.0) / max(base['peak_mb'], 1.0)
+            if ratio > threshold or memory > threshold:
+                regressed.append(r['name'])
+            ratio = 'x%.2f%s' % (ratio, '' if r['name'] not in regressed else ' !')
+        print '%-16s %9d %9.4f %9.2f %9.1f %9s' % (r['name'], r['bytes'] / 1024,
+            r['seconds'], r['mb_per_s'], r['peak_mb'], ratio)
+        for key in ('stages', 'steps'):
+            total = sum(r[key].values()) or 1
+            print '    %s: %s' % (key, ', '.join('%s %.0f%%' % (k.strip('_'), v * 100 / total)
+                for k, v in sorted(r[key].items(), key=lambda kv: -kv[1]) if v * 20 >= total))
+    return regressed
+
+if __name__ == '__main__':
+    args = dict(arg.lstrip('-').split('=', 1) if '=' in arg else (arg.lstrip('-'), True)
+        for arg in sys.argv[1:])
+    path = args.get('baseline', BASELINE)
+    results = run()
+    if 'save' in args:
+        with open(path, 'w') as f:
+            json.dump(dict((r['name'], r) for r in results), f, indent=2, sort_keys=True)
+        report(results, {}, None)
+        print 'saved the baseline to %s' % path
+        sys.exit(0)
+    baseline = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            baseline = json.load(f)
+    regressed = report(results, baseline, float(args.get('threshold', 1.5)))
+    if regressed:
+        print 'regressed: %s' % ', '.join(regressed)
+        sys.exit(1)
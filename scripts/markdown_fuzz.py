@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""Check the worst-case time of markdown conversion.
+
+The pathological inputs, like many unclosed tags, brackets or emphasis
+delimiters, are converted at growing sizes, and the time must grow about
+linearly with the size. Then random texts are converted for a while by the
+converter bounded by 'MARKDOWN_LIMITS' in settings, and none may fail or
+overrun the time limit much.
+
+Usage: python markdown_fuzz.py [seconds of fuzzing, 10 by default]
+"""
+
+__author__="Wenjun Xiao"
+
+import sys, time, random
+
+sys.path.append('../pblog')
+
+import markdown2
+import setting
+
+# the max growth of time when the size grows by SCALE times.
+SCALE = 8
+MAX_GROWTH = SCALE * 2.5
+
+PATHOLOGICAL = {
+    'unclosed tag blocks': lambda n: u'<div>\nx\n' * n + u'</div>x\n',
+    'end tag before tag blocks': lambda n: u'</p>\n' + u'<p>\nx\n' * n,
+    'unclosed tags': lambda n: u'<a b="' * n,
+    'unclosed end tags': lambda n: u'</a b="' * n + u'>',
+    'unclosed auto links': lambda n: u'<http://a ' * n,
+    'unclosed comments': lambda n: u'<!-- a ' * n + u'\n-->',
+    'unclosed brackets': lambda n: u'[' * n,
+    'nested brackets': lambda n: u'[' * n + u']' * n,
+    'unclosed link tails': lambda n: u'[a](' * n,
+    'unclosed reference tails': lambda n: u'[a] [' * n,
+    'unclosed emphasis': lambda n: u'*a _b ' * n,
+    'unclosed strong': lambda n: u'**a __b ' * n,
+    'unclosed code spans': lambda n: u'`a ``b ' * n,
+    'backtick runs': lambda n: u'`' * n,
+    'unclosed backtick runs': lambda n: u'``x' * n,
+    'many links': lambda n: u'[a](http://a.com/ "t") ' * n,
+    'lists': lambda n: u'* a\n  * b\n' * n,
+    'block quotes': lambda n: u'> a\n' * n,
+    'code blocks': lambda n: u'    a\n\n' * n,
+    'entities': lambda n: u'&a &#1 < > ' * n,
+}
+
+SNIPPETS = [u'[a](http://a.com/ "t")', u'![i](/i.png)', u'[r][id]', u'[id]: /u\n',
+    u'[', u']', u'(', u')', u'<', u'>', u'&', u'*', u'**', u'_', u'__', u'`',
+    u'``', u'\\', u'<div>\n', u'</div>\n', u'<b>', u'</b>', u'<!--', u'-->',
+    u'<http://a.com/>', u'<a@b.com>', u'\n', u'\n\n', u'    ', u'> ', u'* ',
+    u'1. ', u'# ', u'---\n', u'text', u' ', u'"', u"'"]
+
+def timeit(converter, text):
+    start = time.time()
+    converter.convert(text)
+    return time.time() - start
+
+def check_growth(n=500):
+    """Return the names of pathological inputs whose time grows faster than
+    linearly."""
+    converter = markdown2.Markdown()
+    failed = []
+    for name in sorted(PATHOLOGICAL):
+        make = PATHOLOGICAL[name]
+        small = min(timeit(converter, make(n)) for i in range(3))
+        large = min(timeit(converter, make(n * SCALE)) for i in range(3))
+        growth = large / max(small, 0.001)
+        ok = growth <= MAX_GROWTH
+        if not ok:
+            failed.append(name)
+        print '%-28s %7.3fs %7.3fs  x%-5.1f %s' % (name, small, large, growth,
+            'ok' if ok else 'SUPERLINEAR')
+    return failed
+
+def fuzz(seconds):
+    """Convert random texts by the bounded converters, return the failed
+    texts and the max overrun of the time limit."""
+    limits = dict(setting.MARKDOWN_LIMITS)
+    time_limit = limits.get('time_limit')
+    converters = [markdown2.Markdown(safe_mode=safe_mode, **limits)
+        for safe_mode in (None, 'escape')]
+    failed, overrun, count = [], 0.0, 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        text = u''.join(random.choice(SNIPPETS)
+            for i in range(random.randint(1, 2000)))
+        for converter in converters:
+            start = time.time()
+            try:
+                converter.convert(text)
+            except markdown2.MarkdownLimitError:
+                pass
+            except Exception as e:
+                failed.append((text, e))
+            if time_limit:
+                overrun = max(overrun, time.time() - start - time_limit)
+            count += 1
+    print 'fuzzed %d conversions, max overrun of %ss time limit: %.3fs' % (
+        count, time_limit, overrun)
+    return failed
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    superlinear = check_growth()
+    failed = fuzz(seconds)
+    for text, e in failed[:5]:
+        print 'failed: %r\n  %r' % (text[:200], e)
+    if superlinear or failed:
+        sys.exit(1)
@@ -15,6 +15,13 @@ create table `blogs` (
   `read_count` int default 0,
   `category` varchar(50) not null,
   `tags` varchar(50) not null,
+  `content_html` mediumtext not null,
+  `renderer_version` int default 0,
+  `toc_html` mediumtext not null,
+  `word_count` int default 0,
+  `reading_time` int default 0,
+  `first_image` varchar(500) not null,
+  `excerpt_html` mediumtext not null,
   primary key(`id`)
 )engine=innodb default charset=utf8;
 -- generating SQL for comments:
@@ -0,0 +1,9 @@
+-- upgrade the database made by an older schema.sql to store the table of
+-- contents, word count, reading time and first image of blogs, run
+-- scripts/backfill_html.py after it.
+use pblog;
+alter table `blogs`
+  add column `toc_html` mediumtext not null,
+  add column `word_count` int default 0,
+  add column `reading_time` int default 0,
+  add column `first_image` varchar(500) not null;
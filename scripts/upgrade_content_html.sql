@@ -0,0 +1,6 @@
+-- upgrade the database made by an older schema.sql to store the rendered
+-- HTML of blogs, run scripts/backfill_html.py after it.
+use pblog;
+alter table `blogs`
+  add column `content_html` mediumtext not null,
+  add column `renderer_version` int default 0;
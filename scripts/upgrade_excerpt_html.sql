@@ -0,0 +1,5 @@
+-- upgrade the database made by an older schema.sql to store the excerpt
+-- HTML of blogs shown by list pages, run scripts/backfill_html.py after it.
+use pblog;
+alter table `blogs`
+  add column `excerpt_html` mediumtext not null;